@@ -35,11 +35,32 @@ class Config(MonkeyDict):
                                "framework_src": None,
                                "framework_bin": None,
 
-        # Build commands: preparing & compiling (additional keys: $source_dir, $build_dir)
+        # Build commands: preparing & compiling (additional keys: $source_dir, $build_dir, $jobs, $jobserver_auth, $makeflags)
         # Command format: list[] is single command's elements (command and arguments); tuple() is list of commands.
                                "prep_cmd": None,
                                "compile_cmd": None,
-                               "post_cmd": None})
+                               "post_cmd": None,
+
+        # Job slots shared by all builds through a GNU make jobserver (None: no jobserver; herp -j overrides this)
+                               "jobs": None,
+
+        # Reference solution (submission-style folder), used for timeout calibration
+                               "reference": None})
+
+        # Resource limits (toolbox.ProcessLimits) for test processes and for build commands; None means no limits.
+        self.limits = MonkeyDict({"test": None, "build": None})
+
+        # Timeout calibration: before grading, the reference solution (build.reference, a submission-style folder) is
+        # built and each test is run on it "runs" times; test timeouts are then multiple * p95 latency + floor (seconds).
+        self.calibration = MonkeyDict({"runs": 0,
+                                       "multiple": 3.0,
+                                       "floor": 1.0,
+                                       "cache_file": "calibration.json"})
+        self.timeouts = {}
+
+        # Memoize test process output per subject: repeated runs of a command (same directory, command, input, and
+        # environment) within one subject reuse the first run's output, which is discarded after shutdown_subject.
+        self.memoize_output = False
 
         # Process specially recognized keywords
         if "threaded" in keywords:
@@ -63,6 +84,7 @@ class Config(MonkeyDict):
         self.build.base = os.path.abspath(self.build.base) if attr_has_value(self.build, "base") else None
         self.build.destination = os.path.abspath(self.build.destination) if attr_has_value(self.build, "destination") else None
         self.build.resources = os.path.abspath(self.build.resources) if attr_has_value(self.build, "resources") else None
+        self.build.reference = os.path.abspath(self.build.reference) if attr_has_value(self.build, "reference") else None
 
         self.build.subject_src = os.path.abspath(self.build.subject_src) if attr_has_value(self.build, "subject_src") else None
         self.build.subject_bin = os.path.abspath(self.build.subject_bin) if attr_has_value(self.build, "subject_bin") else None
@@ -70,6 +92,12 @@ class Config(MonkeyDict):
         self.build.framework_bin = os.path.abspath(self.build.framework_bin) if attr_has_value(self.build, "framework_bin") else None
 
 
+    # Returns the calibrated timeout (seconds) for a test, or the default if it hasn't been calibrated. The table is keyed
+    # by set id, then by test number as a string (as in the calibration cache).
+    def get_timeout(self, set_id, test_num, default=None):
+        return self.timeouts.get(set_id, {}).get(str(test_num), default)
+
+
     ######################################################
     # Initialization and shutdown of components
 
@@ -127,6 +155,22 @@ class TestSet:
         else:
             raise Exception("Test run function is not callable")
 
+        # Assign the (optional) batch run function, which runs several tests at once. If it isn't valid, throw an exception.
+        batch_function = keywords.pop("batch_function", None)
+        if batch_function is None:
+            self.run_case_batch = None
+        elif callable(batch_function):
+            if len(inspect.getfullargspec(batch_function).args) == len(inspect.getfullargspec(TestSet.__run_batch_template).args):
+                self.run_case_batch = batch_function
+            else:
+                raise Exception("Batch run function has wrong number of paramters")
+        else:
+            raise Exception("Batch run function is not callable")
+
+        self._batch_size = keywords.pop("batch_size", None)
+        if self._batch_size is not None and (not isinstance(self._batch_size, int) or self._batch_size < 1):
+            raise Exception("Batch size must be a positive integer (or None)")
+
         # Grab optional keyword argument values
         self._max_score = keywords.pop("max_score", 100.0)
         self._max_penalty = keywords.pop("max_penalty", 0.0)
@@ -178,6 +222,17 @@ class TestSet:
         return self._max_penalty
 
 
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+
+    # Splits the tests to run into batches (of batch_size; one batch if None, or one test per batch without a batch function).
+    def get_batches(self, test_nums):
+        size = (self._batch_size or max(len(test_nums), 1)) if self.run_case_batch else 1
+        return [test_nums[start:start + size] for start in range(0, len(test_nums), size)]
+
+
     @staticmethod
     def __num_tests_template(set_context, subject, framework, cfg):
         raise Exception("Template function should never be called!")
@@ -189,6 +244,11 @@ class TestSet:
         pass
 
 
+    @staticmethod
+    def __run_batch_template(test_nums, set_context, subject, framework, cfg):
+        raise Exception("Template function should never be called!")
+
+
     @staticmethod
     def __get_test_description(test_num, *arg_list, **keywords):
         return "Test #%d" % test_num
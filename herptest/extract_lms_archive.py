@@ -5,137 +5,427 @@ import tarfile
 import zipfile
 
 import tempfile
-import glob
+import hashlib
+import json
 import os
 import os.path
 import shutil
 import argparse
 import re
+import zlib
+from concurrent import futures
 from enum import Enum
 
 Lms = Enum('LMS', ['Canvas', 'ZyBooks'])
 CANVAS_PATTERN = r"(?P<name>[^_]*)(?P<late>_LATE)?_(?P<lms_id>[0-9]*)_(?P<sub_id>[0-9]*)_(?P<filename>.*)"
 
+COPY_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_SIZE = 1024 ** 3   # Maximum number of bytes extracted from any one submission file
+DEFAULT_MAX_RATIO = 200        # Maximum ratio of extracted bytes to compressed bytes for any one submission file
 
-def main():
-    parser = argparse.ArgumentParser(description="Unzips submissions from LMS. Defaults to Canvas format.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_help = True
-    parser.add_argument('filename', help='submissions zip file')
-    parser.add_argument('destination', help='where to extract submissions to')
-    parser.add_argument('-z', '--zybooks', help='process ZyBooks archive', action='store_true')
+# Per-destination record of extracted entries (for incremental runs), and the report of what the last run changed.
+MANIFEST_FILE = ".elma_manifest.json"
+CHANGES_FILE = ".elma_changes.json"
 
-    args = parser.parse_args()
-    filetype = (Lms.ZyBooks if args.zybooks else Lms.Canvas) # Default to Canvas file type
+# Content-addressed store of extracted files (with --dedupe), shared by all student folders via hard links.
+BLOB_DIR = ".elma_blobs"
 
-    # Set up a temporary working directory for submission data and extract the archive.
-    tmp_path = tempfile.mkdtemp()
-    with zipfile.ZipFile(args.filename) as zf:
-        zf.extractall(path=tmp_path)
+# Manifest record fields which determine whether a student folder must be re-extracted.
+RECORD_KEYS = ("lms_id", "sub_ids", "entries", "dedupe")
+
+# Archive reader for pool workers (opened once per worker process).
+_archive = None
+
+
+class ExtractionLimitError(Exception):
+    pass
+
+
+class Limits:
+    """Size and compression ratio limits (guarding against decompression bombs) for one submission file"""
+    def __init__(self, compressed_size, max_size=DEFAULT_MAX_SIZE, max_ratio=DEFAULT_MAX_RATIO):
+        self.compressed_size = max(compressed_size, 1)
+        self.max_size = max_size
+        self.max_ratio = max_ratio
+        self.total = 0
+
+
+    # Accounts for extracted bytes, raising an exception if the limits are exceeded.
+    def add(self, count):
+        self.total += count
+        if self.total > self.max_size:
+            raise ExtractionLimitError("extracted size exceeds %d bytes" % self.max_size)
+        if self.total / self.compressed_size > self.max_ratio:
+            raise ExtractionLimitError("compression ratio exceeds %d" % self.max_ratio)
+
+
+# Copies a stream in bounded chunks, accounting for the bytes against the limits and updating the digest (if any).
+def _copy_stream(source, destination, limits=None, digest=None):
+    while True:
+        chunk = source.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        if limits:
+            limits.add(len(chunk))
+        if digest:
+            digest.update(chunk)
+        destination.write(chunk)
+
+
+# Returns the destination for an archive member, or None if it would land outside of the root (e.g., "../x").
+def _member_path(root, name):
+    target = os.path.normpath(os.path.join(root, name))
+    if os.path.isabs(name) or not target.startswith(os.path.join(os.path.normpath(root), "")):
+        return None
+    return target
+
+
+# Returns a hash identifying a submission's file tree, given a {relative path: content id} mapping.
+def tree_hash(files):
+    return hashlib.sha256("".join("%s %s\n" % (files[name], name) for name in sorted(files)).encode()).hexdigest()
+
+
+class SubmissionWriter:
+    """Writes extracted files into a student folder, recording their content hashes. With a blob store, each distinct
+    content is stored once (read-only, named by its hash) and hardlinked into the student folder."""
+    def __init__(self, student_path, blob_path=None):
+        self.student_path = student_path
+        self.blob_path = blob_path
+        self.files = {}
 
-    # Go through the raw submission files one at a time.
-    submissions = glob.glob(os.path.join(tmp_path, "*"))
-    success_count = 0
-    warning_count = 0
 
-    for rawfile in submissions:
-        success_count += 1
-
-        # separate the submission name from the file type (for later use)
-        submission, ext = os.path.splitext(rawfile)
-
-        # Handle the special case of gzip files (which by default contain another extension)
-        while ext and ext.lower().split('.')[1] == "gz":
-           submission, ext2 = os.path.splitext(submission)
-           ext = ext2 + ext
-
-        # Based in the LMS type, extract submission information from the submission string.
-        if filetype == Lms.Canvas:
-            attributes = re.match(CANVAS_PATTERN, os.path.basename(submission))
-
-            # Deal with Canvas appending "LATE" to student names with an underscore (add to name with a dash)
-            student = attributes.group('name')
-            lms_id = attributes.group('lms_id')
-            submission_id = attributes.group('sub_id')
-            header = attributes.group('filename')
-            late = (True if attributes.group('late') else False)
-
-            # Give a warning if there was trouble parsing the name.
-            if not (student or lms_id or submission_id or header):
-                print("Warning: missing elements in [%s]. Rebuilt files may be malformed." % submission)
-
-            # Account for Canvas's submission count suffix (gross, Canvas).
-            count_info = header.rsplit("-", 1)
-            if len(count_info) > 1:
-                try:
-                    int(count_info[1])
-                    header = count_info[0]
-                except ValueError:
-                    pass # Right side of "-" was not a number, so this is not a Canvas submission count suffix.
-
-        # Handler for ZyBooks submissions - TODO: Redo with regex (as above)
-        elif filetype == Lms.ZyBooks:
-            attributes = os.path.basename(submission).rsplit("_", 3)
-
-            # Handle missing elements in filenames as best we can (limited to weird Canvas output configurations)
-            if len(attributes) < 4:
-                print("Warning: [%s] cannot be reformatted. Assuming generic values." % submission)
-                attributes[1:1] = [""] * 4 - len(attributes)
-
-            student, lms_id, submission_date, submission_time = attributes
-            submission_id = submission_date + "." + submission_time
-            header = "submission"
-
-        # We shouldn't reach this. If we do, something is wrong; it should catch invalid LMS types.
+    # Writes a file's contents from the source stream; partially written files are removed if extraction fails.
+    def write(self, source, target, limits=None, executable=False):
+        digest = hashlib.sha256()
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        if self.blob_path:
+            outfile = tempfile.NamedTemporaryFile(dir=self.blob_path, delete=False)
         else:
-            print("Uh-oh, invalid LMS type... we should never get here!")
-            exit(1)
+            outfile = open(target, "wb")
+
+        try:
+            with outfile:
+                _copy_stream(source, outfile, limits, digest)
+        except BaseException:
+            os.remove(outfile.name)
+            raise
+
+        content_id = digest.hexdigest() + ("-x" if executable else "")
+        if self.blob_path:
+            blob = os.path.join(self.blob_path, content_id[:2], content_id)
+            self._store(outfile.name, blob, 0o555 if executable else 0o444)
+            self._link(blob, target)
+        elif executable:
+            os.chmod(target, 0o755)
+
+        self.files[os.path.relpath(target, self.student_path).replace(os.sep, "/")] = content_id
+
+
+    # Moves new content into the store (or discards it, if the store already has it).
+    @staticmethod
+    def _store(filename, blob, mode):
+        if os.path.isfile(blob):
+            os.remove(filename)
+            return
+
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.chmod(filename, mode)
+        os.replace(filename, blob)
+
+
+    @staticmethod
+    def _link(blob, target):
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(blob, target)
+        except OSError:
+            shutil.copyfile(blob, target) # Hard links aren't supported here (e.g., on some file systems).
+
+
+def _extract_zip(source, writer, limits):
+    # Nested zip files need random access, so spool this one (and only this one) to a temporary file.
+    with tempfile.TemporaryFile() as spool:
+        _copy_stream(source, spool)
+        with zipfile.ZipFile(spool) as zf:
+            members = zf.infolist()
+            limits.add(sum(member.file_size for member in members))
+
+            for member in members:
+                target = _member_path(writer.student_path, member.filename)
+                if not target:
+                    continue
+                if member.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+
+                with zf.open(member) as member_file:
+                    writer.write(member_file, target)
+
+
+def _extract_tar(source, writer, compressed, limits):
+    # Tar files can be read as a stream, one member at a time.
+    with tarfile.open(fileobj=source, mode=("r|gz" if compressed else "r|")) as tf:
+        for member in tf:
+            target = _member_path(writer.student_path, member.name)
+            if not target:
+                continue
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+            elif member.isfile():
+                writer.write(tf.extractfile(member), target, limits, bool(member.mode & 0o111))
+
+
+# Extracts one nested archive entry of the LMS archive; runs in a pool worker. Returns the warnings and the
+# {relative path: content id} of the files written.
+def extract_entry(entry_name, ext, student_path, filename, max_size, max_ratio, blob_path=None):
+    info = _archive.getinfo(entry_name)
+    limits = Limits(info.file_size, max_size, max_ratio)
+    writer = SubmissionWriter(student_path, blob_path)
+
+    try:
+        with _archive.open(info) as source:
+            if ext == ".zip":
+                _extract_zip(source, writer, limits)
+            elif ext == ".tgz" or ext == ".tar.gz" or ext.endswith(".tar"):
+                _extract_tar(source, writer, not ext.endswith(".tar"), limits)
+            else:
+                with gzip.open(source, "rb") as gzf:
+                    writer.write(gzf, os.path.join(student_path, filename.rsplit(".", 1)[0]), limits)
+        return [], writer.files
+    except zipfile.BadZipFile:
+        warning = "Warning: [%s] is not a zipfile; treating like normal file." % entry_name
+    except (tarfile.TarError, gzip.BadGzipFile, zlib.error, EOFError):
+        warning = "Warning: [%s] could not be read / extracted; treating like normal file." % entry_name
+    except ExtractionLimitError as error:
+        warning = "Warning: [%s] %s; copying it as a normal file." % (entry_name, error)
+    except OSError:
+        warning = "Warning: could not write extracted file; copying [%s] as normal file." % entry_name
+
+    with _archive.open(info) as source:
+        writer.write(source, os.path.join(student_path, filename))
+    return [warning], writer.files
+
+
+def _open_archive(filename):
+    global _archive
+    _archive = zipfile.ZipFile(filename)
+
+
+# Extract submission information (student, LMS id, submission id, header, and extension) from an entry name.
+def parse_submission(entry_name, filetype):
+    # separate the submission name from the file type (for later use)
+    submission, ext = os.path.splitext(os.path.basename(entry_name))
+
+    # Handle the special case of gzip files (which by default contain another extension)
+    while ext and ext.lower().split('.')[1] == "gz":
+       submission, ext2 = os.path.splitext(submission)
+       ext = ext2 + ext
+
+    # Based in the LMS type, extract submission information from the submission string.
+    if filetype == Lms.Canvas:
+        attributes = re.match(CANVAS_PATTERN, submission)
+
+        # Deal with Canvas appending "LATE" to student names with an underscore (add to name with a dash)
+        student = attributes.group('name')
+        lms_id = attributes.group('lms_id')
+        submission_id = attributes.group('sub_id')
+        header = attributes.group('filename')
+
+        # Give a warning if there was trouble parsing the name.
+        if not (student or lms_id or submission_id or header):
+            print("Warning: missing elements in [%s]. Rebuilt files may be malformed." % submission)
+
+        # Account for Canvas's submission count suffix (gross, Canvas).
+        count_info = header.rsplit("-", 1)
+        if len(count_info) > 1:
+            try:
+                int(count_info[1])
+                header = count_info[0]
+            except ValueError:
+                pass # Right side of "-" was not a number, so this is not a Canvas submission count suffix.
 
         # If the submission was late, mark it as such.
         if attributes.group('late'):
             student += "-LATE"
 
-        # Now that we've processed submission information, reconstruct the files.
-        ext = ext.lower()
-        filename = header + ext
+    # Handler for ZyBooks submissions - TODO: Redo with regex (as above)
+    elif filetype == Lms.ZyBooks:
+        attributes = submission.rsplit("_", 3)
+
+        # Handle missing elements in filenames as best we can (limited to weird Canvas output configurations)
+        if len(attributes) < 4:
+            print("Warning: [%s] cannot be reformatted. Assuming generic values." % submission)
+            attributes[1:1] = [""] * (4 - len(attributes))
+
+        student, lms_id, submission_date, submission_time = attributes
+        submission_id = submission_date + "." + submission_time
+        header = "submission"
+
+    # We shouldn't reach this. If we do, something is wrong; it should catch invalid LMS types.
+    else:
+        print("Uh-oh, invalid LMS type... we should never get here!")
+        exit(1)
+
+    return student, lms_id, submission_id, header, ext.lower()
+
+
+def is_nested_archive(ext):
+    return ext == ".zip" or ext == ".tgz" or ext == ".tar.gz" or ext.endswith(".tar") or ext.endswith(".gz")
+
+
+def load_manifest(destination):
+    try:
+        with open(os.path.join(destination, MANIFEST_FILE), "r") as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {"students": {}}
 
-        student_path = os.path.join(args.destination, student + "_" + lms_id)
 
-        if not os.path.isdir(student_path):
+# Writes a JSON file (e.g., the manifest) by way of a temporary file so an interrupted run never leaves a partial one.
+def _save_json(data, filename):
+    with tempfile.NamedTemporaryFile(mode="w", dir=os.path.dirname(filename), delete=False) as tmp_file:
+        json.dump(data, tmp_file, indent=1, sort_keys=True)
+    os.replace(tmp_file.name, filename)
+
+
+# Extracts an LMS archive into the destination, yielding (folder, status, file count, warnings) for each student folder
+# as soon as it has been written, so consumers (e.g., herp --from-archive) can start on it during extraction. Status is
+# "added", "updated", "unchanged", or "missing" (in the manifest from an earlier run but not in this archive). The
+# manifest and changes report are saved once all folders are done.
+def extract_submissions(filename, destination, filetype=Lms.Canvas, jobs=None, full=False, max_size=DEFAULT_MAX_SIZE,
+                        max_ratio=DEFAULT_MAX_RATIO, dedupe=False):
+    jobs = jobs or os.cpu_count()
+    os.makedirs(destination, exist_ok=True)
+    manifest = {"students": {}} if full else load_manifest(destination)
+    students = {}
+
+    blob_path = os.path.join(destination, BLOB_DIR) if dedupe else None
+    if blob_path:
+        os.makedirs(blob_path, exist_ok=True)
+
+    with zipfile.ZipFile(filename) as zf, \
+         futures.ProcessPoolExecutor(jobs, initializer=_open_archive, initargs=(filename,)) as executor:
+        # Group the raw submission files (only top-level files are submissions) by student folder.
+        for info in zf.infolist():
+            if info.is_dir() or "/" in info.filename:
+                continue
+
+            student, lms_id, submission_id, header, ext = parse_submission(info.filename, filetype)
+            record = students.setdefault(student + "_" + lms_id, {"lms_id": lms_id, "sub_ids": [], "entries": {},
+                                                                 "dedupe": dedupe, "files": []})
+            if submission_id not in record["sub_ids"]:
+                record["sub_ids"].append(submission_id)
+            record["entries"][info.filename] = [info.CRC, info.file_size]
+            record["files"].append((info, header + ext, ext))
+
+        # Only students whose submission entries differ from the manifest need to be (re-)extracted.
+        changes = {"added": [], "updated": [], "unchanged": [],
+                   "missing": sorted(set(manifest["students"]) - set(students))}
+        in_flight = {}
+
+        for folder, record in sorted(students.items()):
+            previous = manifest["students"].get(folder)
+            student_path = os.path.join(destination, folder)
+            files = record.pop("files")
+
+            if previous and all(previous.get(key) == record[key] for key in RECORD_KEYS) and os.path.isdir(student_path):
+                record["tree_hash"] = previous.get("tree_hash")
+                changes["unchanged"].append(folder)
+                yield folder, "unchanged", 0, []
+                continue
+
+            # Superseded submissions are replaced entirely (so no stale files from older submissions are left).
+            status = "updated" if previous else "added"
+            changes[status].append(folder)
+            if os.path.isdir(student_path):
+                shutil.rmtree(student_path)
             os.makedirs(student_path)
 
-        if ext == ".zip":
-            try:
-                with zipfile.ZipFile(rawfile) as zf:
-                    zf.extractall(path=student_path)
-            except zipfile.BadZipFile:
-                print("Warning: [%s] is not a zipfile; treating like normal file." % os.path.basename(rawfile))
-                shutil.copyfile(rawfile, os.path.join(student_path, filename))
-                warning_count += 1
-        elif ext == ".tgz" or ext == ".tar.gz" or ext.endswith(".tar"):
-            try:
-                with tarfile.open(rawfile, ("r" if ext.endswith(".tar") else "r:gz")) as tf:
-                    tf.extractall(path=student_path)
-            except tarfile.TarError:
-                print("Warning: [%s] could not be read / extracted; treating like normal file." % os.path.basename(rawfile))
-                shutil.copyfile(rawfile, os.path.join(student_path, filename))
-                warning_count += 1
-        elif ext.lower().endswith(".gz"):
-            try:
-                with gzip.open(rawfile, "rb") as gzf:
-                    with open(os.path.join(student_path, filename.rsplit(".", 1)[0]), "wb") as outfile:
-                        outfile.write(gzf.read())
-            except gzip.BadGzipFile:
-                print("Warning: [%s] could not be read / extracted; treating like normal file." % os.path.basename(rawfile))
-                shutil.copyfile(rawfile, os.path.join(student_path, filename))
-                warning_count += 1
-            except:
-                print("Warning: could not write extracted file; copying [%s] as normal file." % os.path.basename(rawfile))
-                shutil.copyfile(rawfile, os.path.join(student_path, filename))
-                warning_count += 1
-        else:
-            shutil.copyfile(rawfile, os.path.join(student_path, filename))
+            # Stream the raw submission files directly from the archive; nested archives are extracted by the pool.
+            writer = SubmissionWriter(student_path, blob_path)
+            pending = []
+            for info, name, ext in files:
+                if is_nested_archive(ext):
+                    pending.append(executor.submit(extract_entry, info.filename, ext, student_path, name,
+                                                   max_size, max_ratio, blob_path))
+                else:
+                    with zf.open(info) as source:
+                        writer.write(source, os.path.join(student_path, name))
+            in_flight[folder] = (status, len(files), writer.files, pending)
+
+            # Hand off finished folders as we go; bound the work in flight (and so the disk used ahead of consumers).
+            while in_flight:
+                done = [folder for folder, (_, _, _, pending) in in_flight.items() if all(f.done() for f in pending)]
+                if done or len(in_flight) < 2 * jobs:
+                    break
+                futures.wait([f for entry in in_flight.values() for f in entry[3] if not f.done()],
+                             return_when=futures.FIRST_COMPLETED)
+
+            for done_folder in done:
+                yield _finish_folder(done_folder, in_flight.pop(done_folder), students)
+
+        # Drain whatever is left.
+        for done_folder in list(in_flight):
+            futures.wait(in_flight[done_folder][3])
+            yield _finish_folder(done_folder, in_flight.pop(done_folder), students)
+
+    # Students missing from this archive keep their folders (and manifest records) from earlier runs.
+    for folder in changes["missing"]:
+        students[folder] = manifest["students"][folder]
+        yield folder, "missing", 0, []
+
+    _save_json({"archive": os.path.basename(filename), "students": students}, os.path.join(destination, MANIFEST_FILE))
+    _save_json(changes, os.path.join(destination, CHANGES_FILE))
+
+
+# Collects a folder's nested extraction results, recording its tree hash (identifying the extracted submission).
+def _finish_folder(folder, entry, students):
+    status, count, files, pending = entry
+    warnings = []
+    for future in pending:
+        entry_warnings, entry_files = future.result()
+        warnings.extend(entry_warnings)
+        files.update(entry_files)
+
+    students[folder]["tree_hash"] = tree_hash(files)
+    return folder, status, count, warnings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Unzips submissions from LMS. Defaults to Canvas format.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_help = True
+    parser.add_argument('filename', help='submissions zip file')
+    parser.add_argument('destination', help='where to extract submissions to')
+    parser.add_argument('-z', '--zybooks', help='process ZyBooks archive', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of parallel extraction processes')
+    parser.add_argument('-f', '--full', help='re-extract all submissions (ignore the manifest)', action='store_true')
+    parser.add_argument('--max-size', type=int, default=DEFAULT_MAX_SIZE, help='maximum bytes extracted per file')
+    parser.add_argument('--max-ratio', type=int, default=DEFAULT_MAX_RATIO, help='maximum compression ratio per file')
+    parser.add_argument('-d', '--dedupe', help='store identical files once and hard link them into student folders',
+                        action='store_true')
+
+    args = parser.parse_args()
+    filetype = (Lms.ZyBooks if args.zybooks else Lms.Canvas) # Default to Canvas file type
+
+    success_count = 0
+    warning_count = 0
+    counts = {"added": 0, "updated": 0, "unchanged": 0, "missing": 0}
+
+    for folder, status, file_count, warnings in extract_submissions(args.filename, args.destination, filetype, args.jobs,
+                                                                    args.full, args.max_size, args.max_ratio,
+                                                                    args.dedupe):
+        for warning in warnings:
+            print(warning)
+        success_count += file_count
+        warning_count += len(warnings)
+        counts[status] += 1
 
     print("Successfuly extracted %d submissions with %d warnings." % (success_count, warning_count))
+    print("Added: %d, updated: %d, unchanged: %d, missing from archive: %d (see %s)." %
+          (counts["added"], counts["updated"], counts["unchanged"], counts["missing"],
+           os.path.join(args.destination, CHANGES_FILE)))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+
+import argparse
+import fnmatch
+import hashlib
+import itertools
+import json
+import os
+import os.path
+import re
+import zlib
+from concurrent import futures
+
+import numpy
+
+# Source files considered by default (by name pattern).
+DEFAULT_PATTERNS = ("*.c", "*.cc", "*.cpp", "*.h", "*.hpp", "*.java", "*.py", "*.js", "*.ts", "*.cs", "*.go", "*.rs")
+
+DEFAULT_SHINGLE_SIZE = 5       # Tokens per shingle
+DEFAULT_NUM_PERM = 128         # MinHash signature length (hash functions)
+DEFAULT_THRESHOLD = 0.5        # Minimum estimated Jaccard similarity of reported pairs
+
+# Per-directory cache of submission signatures (for incremental runs); caches of other versions are discarded.
+CACHE_FILE = ".herp_similar.json"
+CACHE_VERSION = 2
+
+# Source tokens: identifiers / keywords, numbers, and single punctuation characters (whitespace is ignored).
+TOKEN_PATTERN = re.compile(r"[A-Za-z_]\w*|\d+(?:\.\d+)?|\S")
+
+_MERSENNE_PRIME = numpy.uint64((1 << 61) - 1)
+_MAX_HASH = numpy.uint64((1 << 32) - 1)
+_LOW_29 = numpy.uint64((1 << 29) - 1)
+_SHINGLE_BASE = numpy.uint64(1099511628211)
+_HASH_CHUNK = 4096
+
+
+# Returns the paths (relative to the folder, sorted) of the source files in a submission folder; hidden files and
+# folders are skipped.
+def source_files(folder, patterns=DEFAULT_PATTERNS):
+    found = []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [name for name in dirs if not name.startswith(".")]
+        for name in files:
+            if not name.startswith(".") and any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                found.append(os.path.relpath(os.path.join(root, name), folder))
+    return sorted(found)
+
+
+# Returns a fingerprint of a submission folder's source files (names, sizes, and modification times).
+def fingerprint(folder, patterns=DEFAULT_PATTERNS):
+    digest = hashlib.sha256()
+    for relpath in source_files(folder, patterns):
+        stats = os.stat(os.path.join(folder, relpath))
+        digest.update(("%s %d %d\n" % (relpath, stats.st_size, stats.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+# Returns the (unique, 32-bit) hashes of the token shingles of a folder's source files. Each file is shingled on its own
+# so that file order doesn't matter; shingle hashes are rolled over the token hashes with NumPy.
+def shingle_hashes(folder, patterns=DEFAULT_PATTERNS, shingle_size=DEFAULT_SHINGLE_SIZE):
+    hashes = []
+    for relpath in source_files(folder, patterns):
+        with open(os.path.join(folder, relpath), "r", errors="replace") as source:
+            tokens = TOKEN_PATTERN.findall(source.read())
+        if not tokens:
+            continue
+
+        token_hashes = numpy.array([zlib.crc32(token.encode()) for token in tokens], dtype=numpy.uint64)
+        count = max(len(token_hashes) - shingle_size + 1, 1)
+        rolled = numpy.zeros(count, dtype=numpy.uint64)
+        for offset in range(min(shingle_size, len(token_hashes))):
+            rolled = rolled * _SHINGLE_BASE + token_hashes[offset:offset + count]
+        hashes.append((rolled >> numpy.uint64(32)) ^ (rolled & _MAX_HASH))
+
+    return numpy.unique(numpy.concatenate(hashes)) if hashes else numpy.zeros(0, dtype=numpy.uint64)
+
+
+# Reduces values (below 2^64) modulo the Mersenne prime 2^61 - 1.
+def _mod_mersenne(values):
+    values = (values & _MERSENNE_PRIME) + (values >> numpy.uint64(61))
+    return numpy.where(values >= _MERSENNE_PRIME, values - _MERSENNE_PRIME, values)
+
+
+class MinHasher:
+    """MinHash signatures of 32-bit hash sets, from seeded universal hash functions ((a * x + b) mod (2^61 - 1))"""
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, seed=1):
+        generator = numpy.random.RandomState(seed)
+        self.a = generator.randint(1, (1 << 61) - 1, size=num_perm, dtype=numpy.uint64)
+        self.b = generator.randint(0, (1 << 61) - 1, size=num_perm, dtype=numpy.uint64)
+        self._a_high = (self.a >> numpy.uint64(32))[:, None]
+        self._a_low = (self.a & _MAX_HASH)[:, None]
+
+
+    # Returns (a * x + b) mod (2^61 - 1) for every function and hash, exactly: a * x would overflow 64 bits, so it's
+    # split into a_high * x * 2^32 + a_low * x, and each part is reduced using 2^61 = 1 (mod 2^61 - 1).
+    def _permute(self, chunk):
+        high = self._a_high * chunk
+        high = (high >> numpy.uint64(29)) + ((high & _LOW_29) << numpy.uint64(32))
+        return _mod_mersenne(_mod_mersenne(high) + _mod_mersenne(self._a_low * chunk) + self.b[:, None])
+
+
+    # Returns the signature (minimum permuted hash per function, truncated to 32 bits) of a hash array, processing it
+    # in chunks.
+    def signature(self, hashes):
+        signature = numpy.full(len(self.a), _MAX_HASH, dtype=numpy.uint64)
+        for start in range(0, len(hashes), _HASH_CHUNK):
+            permuted = self._permute(hashes[start:start + _HASH_CHUNK]) & _MAX_HASH
+            numpy.minimum(signature, permuted.min(axis=1), out=signature)
+        return signature
+
+
+# Chooses the LSH banding (bands, rows per band) for a signature length whose candidate threshold, (1 / bands) ^ (1 /
+# rows), is closest to the similarity threshold.
+def lsh_parameters(threshold, num_perm=DEFAULT_NUM_PERM):
+    options = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return min(options, key=lambda option: abs((1 / option[0]) ** (1 / option[1]) - threshold))
+
+
+# Computes a submission's signature (in a pool worker); the starter code's shingles, if any, are ignored.
+def _compute_signature(folder, patterns, shingle_size, num_perm, base_hashes):
+    hashes = shingle_hashes(folder, patterns, shingle_size)
+    if base_hashes is not None:
+        hashes = numpy.setdiff1d(hashes, base_hashes, assume_unique=True)
+    return MinHasher(num_perm).signature(hashes).tolist() if len(hashes) else None
+
+
+class SimilarityIndex:
+    """MinHash signatures of the submissions in a directory (one per folder), cached and updated incrementally"""
+    def __init__(self, directory, patterns=DEFAULT_PATTERNS, shingle_size=DEFAULT_SHINGLE_SIZE,
+                 num_perm=DEFAULT_NUM_PERM, base=None, cache_file=None):
+        self.directory = directory
+        self.patterns = tuple(patterns)
+        self.shingle_size = shingle_size
+        self.num_perm = num_perm
+        self.base = os.path.abspath(base) if base else None
+        self.cache_file = cache_file if cache_file else os.path.join(directory, CACHE_FILE)
+        self.entries = {}
+        self._load()
+
+
+    # Settings which, if changed, invalidate all cached signatures.
+    def _identity(self):
+        base_print = fingerprint(self.base, self.patterns) if self.base else None
+        return [CACHE_VERSION, list(self.patterns), self.shingle_size, self.num_perm, base_print]
+
+
+    def _load(self):
+        try:
+            with open(self.cache_file, "r") as cache:
+                cached = json.load(cache)
+            if cached["identity"] == self._identity():
+                self.entries = cached["submissions"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+
+    def save(self):
+        temp_file = self.cache_file + ".tmp"
+        with open(temp_file, "w") as cache:
+            json.dump({"identity": self._identity(), "submissions": self.entries}, cache)
+        os.replace(temp_file, self.cache_file)
+
+
+    # Brings the signatures up to date with the directory's submission folders, computing only those that are new or
+    # have changed (in parallel). Returns counts of added, updated, unchanged, and removed submissions.
+    def update(self, jobs=None):
+        folders = sorted(name for name in os.listdir(self.directory)
+                         if not name.startswith(".") and os.path.isdir(os.path.join(self.directory, name)))
+        counts = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0}
+
+        for name in set(self.entries) - set(folders):
+            del self.entries[name]
+            counts["removed"] += 1
+
+        stale = {}
+        for name in folders:
+            folder_print = fingerprint(os.path.join(self.directory, name), self.patterns)
+            entry = self.entries.get(name)
+            if entry and entry["fingerprint"] == folder_print:
+                counts["unchanged"] += 1
+            else:
+                counts["updated" if entry else "added"] += 1
+                stale[name] = folder_print
+
+        base_hashes = shingle_hashes(self.base, self.patterns, self.shingle_size) if self.base else None
+        with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            pending = {executor.submit(_compute_signature, os.path.join(self.directory, name), self.patterns,
+                                       self.shingle_size, self.num_perm, base_hashes): name for name in stale}
+            for future in futures.as_completed(pending):
+                name = pending[future]
+                self.entries[name] = {"fingerprint": stale[name], "signature": future.result()}
+
+        return counts
+
+
+    # Returns (similarity, submission, submission) for each pair of submissions whose estimated Jaccard similarity is
+    # at least the threshold, most similar first. Only pairs sharing an LSH bucket in some band are compared.
+    def similar_pairs(self, threshold=DEFAULT_THRESHOLD):
+        names = sorted(name for name, entry in self.entries.items() if entry["signature"])
+        if not names:
+            return []
+        signatures = numpy.array([self.entries[name]["signature"] for name in names], dtype=numpy.uint64)
+        bands, rows = lsh_parameters(threshold, self.num_perm)
+
+        candidates = set()
+        for band in range(bands):
+            buckets = {}
+            for index, key in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+                buckets.setdefault(key.tobytes(), []).append(index)
+            for members in buckets.values():
+                candidates.update(itertools.combinations(members, 2))
+
+        pairs = []
+        for left, right in candidates:
+            similarity = float(numpy.mean(signatures[left] == signatures[right]))
+            if similarity >= threshold:
+                pairs.append((similarity, names[left], names[right]))
+        return sorted(pairs, key=lambda pair: (-pair[0], pair[1], pair[2]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Finds near-duplicate submissions (MinHash / LSH over source token "
+                                                 "shingles).", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('directory', nargs='?', default='Projects', help='submissions directory (one folder each)')
+    parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='minimum estimated similarity (Jaccard) of reported pairs')
+    parser.add_argument('-p', '--patterns', default=",".join(DEFAULT_PATTERNS), help='source file name patterns')
+    parser.add_argument('-k', '--shingle-size', type=int, default=DEFAULT_SHINGLE_SIZE, help='tokens per shingle')
+    parser.add_argument('-n', '--num-perm', type=int, default=DEFAULT_NUM_PERM, help='MinHash signature length')
+    parser.add_argument('-b', '--base', help='starter code folder (its shingles are ignored)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of parallel signature processes')
+    parser.add_argument('-c', '--cache', help='signature cache file (default: %s in the directory)' % CACHE_FILE)
+    parser.add_argument('-o', '--output', help='also write the pairs to this CSV file')
+
+    args = parser.parse_args()
+    index = SimilarityIndex(args.directory, [pattern.strip() for pattern in args.patterns.split(",") if pattern.strip()],
+                            args.shingle_size, args.num_perm, args.base, args.cache)
+    counts = index.update(args.jobs)
+    index.save()
+    print("Signatures - added: %d, updated: %d, unchanged: %d, removed: %d." %
+          (counts["added"], counts["updated"], counts["unchanged"], counts["removed"]))
+
+    pairs = index.similar_pairs(args.threshold)
+    for similarity, left, right in pairs:
+        print("%.3f  %s  %s" % (similarity, left, right))
+    print("Found %d pairs with similarity of at least %.2f." % (len(pairs), args.threshold))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write("Similarity,Submission,Submission\n")
+            for similarity, left, right in pairs:
+                output.write("%.3f,%s,%s\n" % (similarity, left, right))
+
+if __name__ == "__main__":
+    main()
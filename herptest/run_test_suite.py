@@ -3,9 +3,16 @@
 # Copyright (c) 2017 Cacti Council Inc., 2018-2020 University of Florida
 
 import argparse
+import collections
+import copy
+import cProfile
+import fnmatch
 import glob
+import hashlib
+import json
 import os
 import shutil
+import stat
 import sys
 import subprocess
 import time
@@ -14,13 +21,28 @@ import traceback
 import numbers
 import string
 import logging
+import pstats
+import queue
+import tempfile
 import dill
 import pathos.pools as pools
+import pathos.helpers
+import numpy
 
 from . import toolbox
+from . import extract_lms_archive
 from . import VERSION
 from concurrent import futures
 
+# Number of functions listed in each ranking of the profile report.
+PROFILE_REPORT_LENGTH = 30
+
+# How long the submission pipeline waits on a stage before checking the others (seconds).
+PIPELINE_POLL_INTERVAL = 0.1
+
+# How long herp waits for the next extracted submission before checking that the extractor is still running (seconds).
+EXTRACTOR_POLL_INTERVAL = 1.0
+
 
 # handle command line args
 def parse_arguments():
@@ -36,6 +58,40 @@ def parse_arguments():
     parser.add_argument('-s', '--set', dest='set', default="*", help = 'test only projects designated (e.g., *_LATE*)')
     parser.add_argument('-T', '--tests', nargs=2, dest='set_tests', action="append", metavar=('test_set','test_list'),
                         default=[], help='testset & tests to run, e.g.: "MySet 1,2,0" (comma-separated); default: all')
+    parser.add_argument('-a', '--from-archive', dest='archive', default=None,
+                        help='extract submissions from an LMS archive (into target_path), testing each as it is ready')
+    parser.add_argument('-z', '--zybooks', dest='zybooks', action='store_true', help='archive is in ZyBooks format')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                        help='job slots shared by all builds through a make jobserver (default: build.jobs, if set)')
+    parser.add_argument('--build-jobs', dest='build_jobs', type=int, default=1, help='number of submissions built at once')
+    parser.add_argument('--test-jobs', dest='test_jobs', type=int, default=1, help='number of submissions tested at once')
+    parser.add_argument('--ready-queue', dest='ready_queue', type=int, default=1,
+                        help='maximum number of built submissions waiting to be tested')
+    parser.add_argument('--overlap', dest='overlap', action='store_true',
+                        help='build submissions while earlier ones are tested (each in its own build destination)')
+    parser.add_argument('-p', '--progress', dest='progress', type=float, nargs='?', const=10.0, default=None,
+                        metavar='SECONDS', help='show a progress status line every SECONDS (default: 10)')
+    parser.add_argument('--metrics-file', dest='metrics_file', default=None,
+                        help='write progress metrics (Prometheus text format) to this file')
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=None,
+                        help='serve progress metrics (Prometheus text format) on this localhost port')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='profile all workers (cProfile); merged stats and a report are saved with the results')
+    parser.add_argument('--recalibrate', dest='recalibrate', action='store_true',
+                        help='recalibrate test timeouts from the reference solution (ignore the cached calibration)')
+    transcripts = parser.add_mutually_exclusive_group()
+    transcripts.add_argument('--record', dest='record', action='store_true',
+                             help='record transcripts (input and output) of test processes for later rescoring')
+    transcripts.add_argument('--replay', dest='replay', action='store_true',
+                             help='rescore from recorded transcripts instead of building / running submissions')
+    parser.add_argument('--transcripts', dest='transcripts', default=None,
+                        help='transcript store location (default: "transcripts" in the result path)')
+    parser.add_argument('--queue-size', dest='queue_size', type=int, default=4,
+                        help='maximum number of extracted submissions waiting to be tested (with --from-archive)')
+    parser.add_argument('--extract-jobs', dest='extract_jobs', type=int, default=None,
+                        help='number of parallel extraction processes (with --from-archive; default: CPU count)')
+    parser.add_argument('--dedupe', dest='dedupe', action='store_true',
+                        help='store identical extracted files once (as elma --dedupe; with --from-archive)')
 
     config = parser.parse_args(sys.argv[1:])
     set_test_mapping = {}
@@ -54,15 +110,27 @@ def parse_arguments():
                 print("Must be comma separated integer list with no spaces (e.g., '4,5,0')")
                 continue
 
+    # The archive is relative to where we were run from (not the suite path).
+    if config.archive:
+        config.archive = os.path.abspath(config.archive)
+    if config.metrics_file:
+        config.metrics_file = os.path.abspath(config.metrics_file)
+    if config.transcripts:
+        config.transcripts = os.path.abspath(config.transcripts)
+
+    config.jobserver = None
+    config.profile_dir = None
+    config.transcript_path = None
     config.logformat = "%(message)s"
     config.set_tests = set_test_mapping
     return config
 
 
-def build_project(source_root, build_root, build_cfg):
+def build_project(source_root, build_root, build_cfg, limits=None, jobserver=None):
     result_error = None
     error_output = None
     current_dir = os.getcwd()
+    connection = jobserver.connect() if jobserver else None
 
     # If there is a not a specified build directory, fall back to the source directory instead (if possible).
     if not build_root:
@@ -85,6 +153,12 @@ def build_project(source_root, build_root, build_cfg):
         replacements = {key : value for key, value in build_cfg.__dict__.items() if not key in ['prep_cmd', 'compile_cmd', 'post_cmd']}
         replacements["source_dir"] = (source_root if source_root else "[NONE]")
         replacements["build_dir"] = (build_root if build_root else "[NONE]")
+
+        # Jobserver substitutions: $jobs is the jobserver's total slot count (shared by every concurrent build, so it
+        # isn't a per-build -j value); make joins the jobserver through MAKEFLAGS on its own.
+        replacements["jobs"] = str(connection.tokens if connection else os.cpu_count())
+        replacements["jobserver_auth"] = connection.auth if connection else ""
+        replacements["makeflags"] = connection.environment()["MAKEFLAGS"] if connection else os.environ.get("MAKEFLAGS", "")
         template = string.Template("")
 
         if hasattr(build_cfg, 'prep_cmd') and build_cfg.prep_cmd:
@@ -95,7 +169,7 @@ def build_project(source_root, build_root, build_cfg):
                 for entry in source_cmd:
                     template.template = entry
                     prep_cmd.append(template.substitute(**replacements))
-                subprocess.check_output(prep_cmd, stderr=subprocess.STDOUT, text=True)
+                run_build_command(prep_cmd, limits, connection)
 
         if hasattr(build_cfg, 'compile_cmd') and build_cfg.compile_cmd:
             # Apply substitutions from the build configuration to the compile command
@@ -105,7 +179,7 @@ def build_project(source_root, build_root, build_cfg):
                 for entry in build_cfg.compile_cmd:
                     template.template = entry
                     compile_cmd.append(template.substitute(**replacements))
-                subprocess.check_output(compile_cmd, stderr=subprocess.STDOUT, text=True)
+                run_build_command(compile_cmd, limits, connection)
 
         if hasattr(build_cfg, 'post_cmd') and build_cfg.post_cmd:
             # Apply substitutions from the build configuration to the prep command(s)
@@ -115,7 +189,7 @@ def build_project(source_root, build_root, build_cfg):
                 for entry in source_cmd:
                     template.template = entry
                     post_cmd.append(template.substitute(**replacements))
-                subprocess.check_output(post_cmd, stderr=subprocess.STDOUT, text=True)
+                run_build_command(post_cmd, limits, connection)
 
     except subprocess.CalledProcessError as error:
         result_error = error
@@ -124,10 +198,22 @@ def build_project(source_root, build_root, build_cfg):
     except FileNotFoundError as error:
         result_error = error
 
-    os.chdir(current_dir)
+    finally:
+        if connection:
+            connection.close()
+        os.chdir(current_dir)
     return result_error, error_output
 
 
+# Runs a build command under the build limits. With a jobserver, the command holds a job slot while it runs, and make
+# (if run) shares the rest of the jobserver's slots with all other builds.
+def run_build_command(command, limits, connection):
+    if not connection:
+        return toolbox.run_limited(command, limits)
+    with connection.slot():
+        return toolbox.run_limited(command, limits, env=connection.environment(), pass_fds=connection.fds)
+
+
 def run_suite_tests(subject, framework, cfg):
     results = []
     exception_sets = {}
@@ -172,6 +258,7 @@ def run_suite_tests(subject, framework, cfg):
 def run_test_set(test_set, subject, framework, cfg):
     # Prepare data structures and initialize the test set.
     exception_list = []
+    toolbox.set_transcript_label("%s/setup" % test_set.id)
     set_context = cfg.initialize_test_set(test_set, subject, framework)
     num_of_total_tests = test_set.get_num_tests(set_context, subject, framework, cfg)
     penalty_totals = [0] * (len(test_set.case_penalties) + len(test_set.set_penalties))
@@ -193,65 +280,451 @@ def run_test_set(test_set, subject, framework, cfg):
     header.extend(["%s-Pen" % penalty[0] for penalty in test_set.case_penalties])
     data_set.append(header)
 
-    # Run each test and scale the score accordingly.
+    # Sanity check: are these test numbers actually among those in the test set? If not, skip them.
+    valid_tests = []
     for test_num in tests_to_run:
-        # Sanity check: is this test number actually among those in the test set? If not, skip it.
         if test_num >= num_of_total_tests:
             logging.info("Warning: %d is greater than total number of tests (%d). Skipping." % (test_num, num_of_total_tests))
             continue
+        valid_tests.append(test_num)
+
+    # Run the tests (in batches, if the test set supports it), scoring each batch's tests as soon as it has run - so
+    # descriptions and penalties see the state the batch (or, without a batch function, the single test) left behind.
+    for batch in test_set.get_batches(valid_tests):
+        case_results = run_case_batch(test_set, batch, set_context, subject, framework, cfg, exception_list)
+        for test_num, case_result in zip(batch, case_results):
+            # Set up the row for this test.
+            row = [ '%d' % test_num ]
+
+            # If we successfuly completed the run, this should be a number; otherwise, a message.
+            if isinstance(case_result, numbers.Number):
+                case_score = case_result
+                message = None
+            else:
+                case_score = 0
+                message = str(case_result)
+
+            score += case_score
+            # Add score, run message, and description as applicable
+            row.append('%.2f%%' % (case_score * 100))
+            row.append(message if message else '')
+            toolbox.set_transcript_label("%s/%d/desc" % (test_set.id, test_num))
+            try:
+                row.append(test_set.get_test_desc(test_num, set_context, subject, framework, cfg)
+                           if round(case_score, 10) < 1 else '')
+            except toolbox.TranscriptError as e:
+                # (When replaying, a description may need a call that was never recorded.)
+                exception_list.append("Test %d description, %s: %s" % (test_num, type(e).__name__, e))
+                row.append('')
+
+            if case_score == 0:
+                data_set.append(row)
+                continue
+
+            # Go through each penalty and run it (if valid).
+            for penalty_num, case_penalty in enumerate(test_set.case_penalties):
+                penalty_name, magnitude, pen_function = case_penalty
+                toolbox.set_transcript_label("%s/%d/penalty%d" % (test_set.id, test_num, penalty_num))
+                try:
+                    penalty = pen_function(penalty_num, test_num, set_context, subject, framework, cfg)
+                except toolbox.TranscriptError as e:
+                    # (When replaying, a penalty may need a call that was never recorded; it isn't applied then.)
+                    exception_list.append("Test %d penalty %d, %s: %s" % (test_num, penalty_num, type(e).__name__, e))
+                    penalty = 0
+                penalty_totals[penalty_num] += penalty * magnitude * case_score / len(tests_to_run)
+                row.append('%.2f%%' % (penalty * 100))
+
+            # Add this test data to the data set.
+            data_set.append(row)
+
+    for penalty_num, set_penalty in enumerate(test_set.set_penalties):
+        penalty_name, magnitude, pen_function = set_penalty
+        toolbox.set_transcript_label("%s/penalty%d" % (test_set.id, penalty_num))
+        penalty = pen_function(penalty_num, set_context, subject, framework, cfg) * score * magnitude
+        penalty_totals[penalty_num + len(test_set.case_penalties)] = penalty
 
-        # Set up the row for this test and run it.
-        row = [ '%d' % test_num ]
+    # Return the data set, score (proportion), and penalty totals
+    toolbox.set_transcript_label("%s/shutdown" % test_set.id)
+    cfg.shutdown_test_set(set_context)
+    return data_set, score / len(tests_to_run), penalty_totals, exception_list
+
+
+# Runs a batch of tests, returning a result for each (a score or a message). Without a batch function, tests are run one
+# at a time; if a batch fails, each of its tests scores 0.
+def run_case_batch(test_set, test_nums, set_context, subject, framework, cfg, exception_list):
+    if test_set.run_case_batch and len(test_nums) > 0:
         try:
-            case_result = test_set.run_case_test(test_num, set_context, subject, framework, cfg)
+            start_time = time.monotonic()
+            toolbox.set_transcript_label("%s/%s" % (test_set.id, ",".join(str(test_num) for test_num in test_nums)))
+            batch_results = list(test_set.run_case_batch(test_nums, set_context, subject, framework, cfg))
+            if len(batch_results) != len(test_nums):
+                raise ValueError("batch function returned %d results for %d tests" % (len(batch_results), len(test_nums)))
+            for test_num in test_nums:
+                toolbox.record_metric("test_seconds", (time.monotonic() - start_time) / len(test_nums))
+            return batch_results
+        except Exception as e:
+            stack_trace = traceback.format_exc()
+            exception_list.append("Tests %s, %s: %s\n%s" % (test_nums, type(e).__name__, e, stack_trace))
+            return [0] * len(test_nums)
+
+    case_results = []
+    for test_num in test_nums:
+        start_time = time.monotonic()
+        toolbox.set_transcript_label("%s/%d" % (test_set.id, test_num))
+        try:
+            case_results.append(test_set.run_case_test(test_num, set_context, subject, framework, cfg))
         except Exception as e:
             stack_trace = traceback.format_exc()
             exception_list.append("Test %d, %s: %s\n%s" % (test_num, type(e).__name__, e, stack_trace))
-            case_result = 0
+            case_results.append(0)
+        toolbox.record_metric("test_seconds", time.monotonic() - start_time)
+    return case_results
 
-        # If we successfuly completed the run, this should be a number; otherwise, a message.
-        if isinstance(case_result, numbers.Number):
-            case_score = case_result
-            message = None
-        else:
-            case_score = 0
-            message = str(case_result)
 
-        score += case_score
-        # Add score, run message, and description as applicable
-        row.append('%.2f%%' % (case_score * 100))
-        row.append(message if message else '')
-        row.append(test_set.get_test_desc(test_num, set_context, subject, framework, cfg) if round(case_score, 10) < 1 else '')
+# Runs the archive extraction (in its own process), handing off each student folder through a bounded queue as soon as
+# it is written - so extraction stays only a limited distance ahead of testing.
+def _extract_archive(archive, destination, filetype, jobs, dedupe, hand_off):
+    try:
+        for folder, status, _, warnings in extract_lms_archive.extract_submissions(archive, destination, filetype, jobs,
+                                                                                   dedupe=dedupe):
+            if status != "missing":
+                hand_off.put((os.path.join(destination, folder), warnings))
+    except Exception as e:
+        hand_off.put((None, ["Error extracting %s - %s: %s" % (archive, type(e).__name__, e)]))
+    hand_off.put(None)
 
-        if case_score == 0:
-            data_set.append(row)
+
+# Yields the submissions to test: the target path's folders or, with an archive, folders as they are extracted.
+def get_submissions(cfg):
+    if not cfg.runtime.archive:
+        yield from glob.glob(os.path.join(cfg.runtime.target_path, cfg.runtime.set))
+        return
+
+    filetype = extract_lms_archive.Lms.ZyBooks if cfg.runtime.zybooks else extract_lms_archive.Lms.Canvas
+    hand_off = pathos.helpers.mp.Queue(max(cfg.runtime.queue_size, 1))
+    extractor = pathos.helpers.mp.Process(target=_extract_archive,
+                                          args=(cfg.runtime.archive, cfg.runtime.target_path, filetype,
+                                                cfg.runtime.extract_jobs, cfg.runtime.dedupe, hand_off))
+    extractor.start()
+
+    try:
+        while True:
+            # If the extractor dies without handing off its end marker, stop once everything it sent has been taken.
+            # (Whatever it sent before dying is already in the queue when it's seen not to be alive.)
+            alive = extractor.is_alive()
+            try:
+                entry = hand_off.get(timeout=EXTRACTOR_POLL_INTERVAL)
+            except queue.Empty:
+                if alive:
+                    continue
+                logging.error("Extraction of %s stopped unexpectedly (exit code %s).\n" %
+                              (cfg.runtime.archive, extractor.exitcode))
+                break
+
+            if entry is None:
+                break
+            submission, warnings = entry
+            for warning in warnings:
+                logging.info(warning + "\n")
+            if submission and fnmatch.fnmatch(os.path.basename(submission), cfg.runtime.set):
+                yield submission
+        extractor.join()
+    finally:
+        # If testing stopped early, the extractor may be blocked handing off the next folder.
+        if extractor.is_alive():
+            extractor.terminate()
+
+
+# Returns a fingerprint of a folder's files (names, sizes, and modification times), leaving out any excluded folders (and
+# hidden / cache folders).
+def _fingerprint_folder(folder, excluded=()):
+    digest = hashlib.sha256()
+    excluded = {os.path.abspath(entry) for entry in excluded if entry}
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(name for name in dirs if not name.startswith(".") and name != "__pycache__"
+                         and os.path.abspath(os.path.join(root, name)) not in excluded)
+        for name in sorted(files):
+            stats = os.stat(os.path.join(root, name))
+            digest.update(("%s %d %d\n" % (os.path.relpath(os.path.join(root, name), folder), stats.st_size,
+                                            stats.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+# Returns a fingerprint of the test suite (its settings, test modules, and data), leaving out the folders herp and the
+# builds write to, the submissions, and the reference (fingerprinted on its own).
+def _fingerprint_suite(cfg):
+    destination = os.path.abspath(cfg.build.destination) if cfg.build.destination else None
+    excluded = [cfg.general.result_path, cfg.runtime.target_path, cfg.build.reference, cfg.build.framework_bin,
+                cfg.runtime.transcript_path]
+    if destination:
+        parent = os.path.dirname(destination)
+        excluded += [os.path.join(parent, name) for name in os.listdir(parent)
+                     if name == os.path.basename(destination) or name.startswith(os.path.basename(destination) + ".")]
+    return _fingerprint_folder(os.getcwd(), excluded)
+
+
+# Returns the test counts that can be known without a subject (those given as numbers), by test set.
+def _static_test_counts(cfg):
+    counts = {}
+    for test_set in cfg.sets:
+        try:
+            counts[test_set.id] = test_set.get_num_tests(None, None, None, cfg)
+        except Exception:
+            counts[test_set.id] = None
+    return counts
+
+
+# Returns the longest process run during a calibration run of a test (or, if it ran none, the whole test), or None if
+# the run can't be used: the reference failed the test, a process timed out / hit a limit, or a process waited out its
+# whole timeout by design (sleep=True), which says nothing about how long it needs.
+def _calibration_sample(test_set, test_num, set_context, reference, framework_context, cfg):
+    processes = []
+    toolbox.set_process_log(processes)
+    start_time = time.monotonic()
+    try:
+        result = test_set.run_case_test(test_num, set_context, reference, framework_context, cfg)
+    except Exception as e:
+        logging.debug("Reference failed test %s %d - %s: %s\n" % (test_set.id, test_num, type(e).__name__, e))
+        return None
+    finally:
+        toolbox.set_process_log(None)
+    elapsed = time.monotonic() - start_time
+
+    if not isinstance(result, numbers.Number) or round(result, 10) < 1:
+        logging.debug("Reference failed test %s %d (result: %s).\n" % (test_set.id, test_num, result))
+        return None
+    for seconds, status, sleep in processes:
+        if sleep or status is None or status.timed_out or status.violation:
+            logging.debug("Reference test %s %d not timed (process status: %s%s).\n" %
+                          (test_set.id, test_num, status, ", sleep" if sleep else ""))
+            return None
+    return max(seconds for seconds, _, _ in processes) if processes else elapsed
+
+
+# Calibrates test timeouts: builds the reference solution (like a submission), runs each test on it several times, and
+# derives each test's timeout as a multiple of the p95 latency of its longest process, plus a floor. (Timeouts are
+# passed to each process, so that is what is timed.) Runs where the reference fails, a process times out, or a process
+# sleeps out its timeout are left out; tests without any usable run keep their default timeouts. Results are cached
+# in the result folder and reused until the reference, the suite, or the calibration settings change.
+def calibrate_timeouts(cfg, framework_context, log_queue=None):
+    calibration = cfg.calibration
+    if not calibration.runs or not cfg.build.reference:
+        return {}
+
+    cache_file = os.path.join(cfg.general.result_path, calibration.cache_file)
+    identity = {"reference": _fingerprint_folder(cfg.build.reference), "suite": _fingerprint_suite(cfg),
+                "runs": calibration.runs, "multiple": calibration.multiple, "floor": calibration.floor,
+                "sets": [test_set.id for test_set in cfg.sets], "num_tests": _static_test_counts(cfg)}
+
+    if not cfg.runtime.recalibrate:
+        try:
+            with open(cache_file, "r") as cache:
+                cached = json.load(cache)
+            if cached["identity"] == identity:
+                logging.info("Using calibrated timeouts from %s.\n" % cache_file)
+                return cached["timeouts"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    # Build and initialize the reference like any submission (in the first staging slot).
+    logging.info("Calibrating timeouts from reference solution (%d runs per test)... " % calibration.runs)
+    setup_exceptions = prepare_submission(cfg.build.reference, cfg, log_queue)
+    toolbox.set_log_submission(None)
+    if setup_exceptions:
+        logging.error("Could not build reference solution; timeouts not calibrated.\n" + "\n".join(setup_exceptions))
+        return {}
+
+    starting_dir = os.getcwd()
+    try:
+        reference = cfg.initialize_subject(cfg.build.reference, framework_context)
+    except Exception as e:
+        os.chdir(starting_dir)
+        logging.error("Could not initialize reference solution; timeouts not calibrated - %s: %s\n%s" %
+                      (type(e).__name__, e, traceback.format_exc()))
+        return {}
+    os.chdir(starting_dir)
+
+    latencies = {}
+    timeouts = {}
+    for test_set in cfg.sets:
+        latencies[test_set.id] = {}
+        timeouts[test_set.id] = {}
+        try:
+            set_context = cfg.initialize_test_set(test_set, reference, framework_context)
+            num_tests = test_set.get_num_tests(set_context, reference, framework_context, cfg)
+        except Exception as e:
+            os.chdir(starting_dir)
+            logging.error("Could not set up test set %s on the reference; its timeouts not calibrated - %s: %s\n" %
+                          (test_set.id, type(e).__name__, e))
             continue
 
-        # Go through each penalty and run it (if valid).
-        for penalty_num, case_penalty in enumerate(test_set.case_penalties):
-            penalty_name, magnitude, pen_function = case_penalty
-            penalty = pen_function(penalty_num, test_num, set_context, subject, framework, cfg)
-            penalty_totals[penalty_num] += penalty * magnitude * case_score / len(tests_to_run)
-            row.append('%.2f%%' % (penalty * 100))
+        for test_num in range(num_tests if isinstance(num_tests, int) else 0):
+            samples = []
+            for run in range(calibration.runs):
+                sample = _calibration_sample(test_set, test_num, set_context, reference, framework_context, cfg)
+                os.chdir(starting_dir)
+                if sample is not None:
+                    samples.append(sample)
+
+            if not samples:
+                logging.info("Warning: no usable reference runs of test %s %d; its timeout was not calibrated.\n" %
+                             (test_set.id, test_num))
+                continue
+            p95 = float(numpy.percentile(samples, 95))
+            latencies[test_set.id][str(test_num)] = {"p50": float(numpy.percentile(samples, 50)), "p95": p95,
+                                                     "max": max(samples), "runs": len(samples)}
+            timeouts[test_set.id][str(test_num)] = calibration.multiple * p95 + calibration.floor
 
-        # Add this test data to the data set.
-        data_set.append(row)
+        try:
+            cfg.shutdown_test_set(set_context)
+        except Exception as e:
+            logging.error("Error shutting down test set %s on the reference - %s: %s\n" %
+                          (test_set.id, type(e).__name__, e))
+        os.chdir(starting_dir)
 
-    for penalty_num, set_penalty in enumerate(test_set.set_penalties):
-        penalty_name, magnitude, pen_function = set_penalty
-        penalty = pen_function(penalty_num, set_context, subject, framework, cfg) * score * magnitude
-        penalty_totals[penalty_num + len(test_set.case_penalties)] = penalty
+    try:
+        cfg.shutdown_subject(reference)
+    except Exception as e:
+        logging.error("Error shutting down the reference - %s: %s\n" % (type(e).__name__, e))
+    os.chdir(starting_dir)
+    logging.info("done.\n")
 
-    # Return the data set, score (proportion), and penalty totals
-    cfg.shutdown_test_set(set_context)
-    return data_set, score / len(tests_to_run), penalty_totals, exception_list
+    try:
+        with open(cache_file, "w") as cache:
+            json.dump({"identity": identity, "latencies": latencies, "timeouts": timeouts}, cache, indent=1)
+    except OSError as e:
+        logging.info("Warning: couldn't save calibrated timeouts to %s (%s).\n" % (cache_file, e))
+
+    return timeouts
+
+
+# Calls the function (a stage, in a worker) under cProfile if profiling, saving its stats for the main process to merge.
+def run_profiled(stage, profile_dir, function, *args):
+    if not profile_dir:
+        return function(*args)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        handle, filename = tempfile.mkstemp(prefix=stage + "-", suffix=".prof", dir=profile_dir)
+        os.close(handle)
+        profiler.dump_stats(filename)
+
+
+# Classifies a profiled function by where it is defined: the test suite, the toolbox, the rest of herptest, or other
+# (the standard library, other packages, and built-ins).
+def _profile_origin(filename, suite_path):
+    if filename.startswith("~") or filename.startswith("<"):
+        return "built-in"
+    if os.path.dirname(os.path.abspath(filename)) == os.path.dirname(os.path.abspath(__file__)):
+        return "toolbox" if os.path.basename(filename) == "toolbox.py" else "herptest"
+    if not os.path.isabs(filename) or filename.startswith(os.path.join(suite_path, "")):
+        return "suite"
+    return "other"
+
+
+# Returns, for each profiled function, the shares of its time owed to each origin: suite / toolbox / herptest functions
+# own their time, and other functions (e.g., time.sleep, subprocess waits) pass it on to their callers in proportion to
+# the time of each call. The call graph is walked depth first (without recursion), so every function's callers are
+# resolved before it; a call from a function that is still being resolved (a cycle) is owed to that caller's origin.
+def _attribute_profile_time(stats, suite_path):
+    origins = {function: _profile_origin(function[0], suite_path) for function in stats.stats}
+    shares = {}
+    resolving = set()
+
+    for start in stats.stats:
+        stack = [start]
+        while stack:
+            function = stack[-1]
+            if function in shares:
+                stack.pop()
+                continue
+
+            origin = origins[function]
+            callers = stats.stats[function][4]
+            if origin in ("suite", "toolbox", "herptest") or not callers:
+                shares[function] = {origin: 1.0}
+                stack.pop()
+                continue
+
+            # Resolve the callers first (the function stays on the stack until they are done).
+            if function not in resolving:
+                resolving.add(function)
+                pending = [caller for caller in callers
+                           if caller in stats.stats and caller not in shares and caller not in resolving]
+                if pending:
+                    stack.extend(pending)
+                    continue
+
+            result = collections.Counter()
+            weights = {caller: edge[3] for caller, edge in callers.items()}
+            total = sum(weights.values())
+            for caller, weight in weights.items():
+                fraction = weight / total if total else 1 / len(weights)
+                caller_origin = origins.get(caller) or _profile_origin(caller[0], suite_path)
+                for owner, share in shares.get(caller, {caller_origin: 1.0}).items():
+                    result[owner] += fraction * share
+
+            shares[function] = result
+            resolving.discard(function)
+            stack.pop()
+
+    return shares
+
+
+# Merges the workers' profiles into one pstats file and writes a ranked report attributing time to suite functions
+# versus toolbox helpers (and everything else).
+def merge_profiles(profile_dir, pstats_file, report_file, suite_path):
+    profiles = sorted(glob.glob(os.path.join(profile_dir, "*.prof")))
+    if not profiles:
+        return
+
+    stats = pstats.Stats(*profiles)
+    stats.dump_stats(pstats_file)
+
+    origin_times = collections.Counter()
+    attributed_times = collections.Counter()
+    shares = _attribute_profile_time(stats, suite_path)
+    rows = []
+    for function, (_, calls, self_time, total_time, _) in stats.stats.items():
+        filename, line, name = function
+        origin = _profile_origin(filename, suite_path)
+        origin_times[origin] += self_time
+        for owner, share in shares[function].items():
+            attributed_times[owner] += self_time * share
+        rows.append((self_time, total_time, calls, origin, "%s:%d(%s)" % (filename, line, name)))
+
+    overall = sum(origin_times.values()) or 1
+    report = ["Profile of %d worker stage(s) (merged stats: %s)" % (len(profiles), pstats_file), ""]
+    report.append("Time by origin (time in other code, e.g. sleeping / waiting on processes, is owed to its callers):")
+    for origin, seconds in attributed_times.most_common():
+        report.append("  %-10s %10.3fs %6.1f%%" % (origin, seconds, 100 * seconds / overall))
+
+    report += ["", "Self time by origin:"]
+    for origin, seconds in origin_times.most_common():
+        report.append("  %-10s %10.3fs %6.1f%%" % (origin, seconds, 100 * seconds / overall))
+
+    header = "  %10s %10s %10s  %-9s %s" % ("self (s)", "total (s)", "calls", "origin", "function")
+    row_format = "  %10.3f %10.3f %10d  %-9s %s"
+    report += ["", "Top functions by self time:", header]
+    report += [row_format % row for row in sorted(rows, reverse=True)[:PROFILE_REPORT_LENGTH]]
+
+    # Cumulative time is only meaningful for code the suite author controls (or calls directly).
+    report += ["", "Top suite / toolbox functions by total time:", header]
+    owned = [row for row in rows if row[3] in ("suite", "toolbox")]
+    report += [row_format % row for row in sorted(owned, key=lambda row: row[1], reverse=True)[:PROFILE_REPORT_LENGTH]]
+
+    with open(report_file, "w") as out_file:
+        out_file.write("\n".join(report) + "\n")
 
 
 # Build the environment components (only need to do this once.)
 def prepare_and_init_framework(cfg):
     if cfg.build.prep_cmd or cfg.build.compile_cmd or cfg.build.post_cmd:
         logging.info("Prepping / building framework environment... ")
-        result_error, error_output = build_project(cfg.build.framework_src, cfg.build.framework_bin, cfg.build)
+        result_error, error_output = build_project(cfg.build.framework_src, cfg.build.framework_bin, cfg.build,
+                                                   cfg.limits.build, cfg.runtime.jobserver)
         if result_error:
             error_text = "%s: %s\n" % (type(result_error).__name__, result_error)
             logging.error(error_output if error_output else error_text)
@@ -263,13 +736,61 @@ def prepare_and_init_framework(cfg):
     logging.info("done.\n")
     return framework_data
 
-# For each submission, copy the base files, then the submission, into the destination folder.
-def prepare_and_test_submission(submission, framework_context, cfg):
-    # Because this might be in a new process, we wil need to reset the console logger when prep the project.
-    console_logger = toolbox.SelectiveStreamHandler(INFO=cfg.runtime.INFO, WARNING=cfg.runtime.WARN, CRITICAL=True)
-    logging.basicConfig(format=cfg.runtime.logformat, level=logging.DEBUG, handlers=[console_logger])
-    root_logger = logging.getLogger('')
-    console_logger.terminator = ""
+# Because this might be in a new process, we will need to reset logging in each stage. If there is a log queue, records
+# are sent (tagged with this submission) to the main process to be written there.
+def _prepare_worker_logging(submission, cfg, log_queue):
+    if log_queue is not None:
+        toolbox.attach_log_queue(log_queue)
+        toolbox.set_log_submission(os.path.basename(submission))
+    else:
+        console_logger = toolbox.SelectiveStreamHandler(INFO=cfg.runtime.INFO, WARNING=cfg.runtime.WARN, CRITICAL=True)
+        logging.basicConfig(format=cfg.runtime.logformat, level=logging.DEBUG, handlers=[console_logger])
+        console_logger.terminator = ""
+
+
+# Returns the configuration for a staging slot. Slot 0 uses the configured build destination; other slots (so that some
+# submissions can be built while others are tested) use their own, "<destination>.<slot>", with subject paths inside
+# the destination moved along with it.
+def get_stage_config(cfg, slot):
+    destination = cfg.build.destination
+    if slot == 0 or not destination:
+        return cfg
+
+    stage_destination = "%s.%d" % (destination, slot)
+    stage_cfg = copy.copy(cfg)
+    stage_cfg.build = copy.copy(cfg.build)
+    for key in ["destination", "subject_src", "subject_bin"]:
+        value = cfg.build[key]
+        if value and (value == destination or value.startswith(destination + os.sep)):
+            stage_cfg.build[key] = stage_destination + value[len(destination):]
+    return stage_cfg
+
+
+# Determines whether every staging slot gets its own copy of the subject's files: the subject paths (if set) must lie
+# inside the build destination, so that get_stage_config moves them along with it.
+def stages_isolated(cfg):
+    destination = cfg.build.destination
+    if not destination:
+        return False
+    return all(not cfg.build[key] or cfg.build[key] == destination or cfg.build[key].startswith(destination + os.sep)
+               for key in ["subject_src", "subject_bin"])
+
+
+# Makes everything in a folder writable by its owner. (Copies keep their source's modes, and files from elma's blob store
+# are read-only; builds and tests may need to change or regenerate their files.)
+def _add_user_write(folder):
+    for root, dirs, files in os.walk(folder):
+        for name in dirs + files:
+            entry = os.path.join(root, name)
+            mode = os.lstat(entry).st_mode
+            if not stat.S_ISLNK(mode) and not mode & stat.S_IWUSR:
+                os.chmod(entry, stat.S_IMODE(mode) | stat.S_IWUSR)
+
+
+# Build stage: copy the base files, then the submission, into the destination folder and build it. Returns the setup
+# exceptions (for the test stage to report).
+def prepare_submission(submission, cfg, log_queue=None):
+    _prepare_worker_logging(submission, cfg, log_queue)
 
     if not os.path.isdir(submission):
         return None
@@ -282,12 +803,14 @@ def prepare_and_test_submission(submission, framework_context, cfg):
     if cfg.build.base:
         shutil.copytree(cfg.build.base, cfg.build.destination, dirs_exist_ok=True)
     shutil.copytree(submission, cfg.build.destination, dirs_exist_ok=True)
+    _add_user_write(cfg.build.destination)
 
-    # Build the project.
+    # Build the project (unless replaying transcripts, which don't need it).
     setup_exceptions = []
     logging.info("Prepping / building project(s) for " + submission + "... ")
-    if cfg.build.prep_cmd or cfg.build.compile_cmd or cfg.build.post_cmd:
-        error, output = build_project(cfg.build.subject_src, cfg.build.subject_bin, cfg.build)
+    if (cfg.build.prep_cmd or cfg.build.compile_cmd or cfg.build.post_cmd) and not cfg.runtime.replay:
+        error, output = build_project(cfg.build.subject_src, cfg.build.subject_bin, cfg.build, cfg.limits.build,
+                                      cfg.runtime.jobserver)
 
         if error:
             logging.info("error building (see logs)... ")
@@ -295,7 +818,36 @@ def prepare_and_test_submission(submission, framework_context, cfg):
             error_text += output if output else ""
             setup_exceptions.append(error_text)
 
-    logging.info("Initializing... ")
+    logging.info("built.\n")
+    return setup_exceptions
+
+
+# Test stage: initialize the (built) subject, run the suite's tests on it, and shut it down.
+def test_submission(submission, framework_context, cfg, setup_exceptions, log_queue=None):
+    _prepare_worker_logging(submission, cfg, log_queue)
+
+    # Test processes started by the suite (e.g., through toolbox.get_cmd_output) run under the configured limits, with
+    # their output memoized for this subject if configured.
+    toolbox.set_process_limits(cfg.limits.test)
+    toolbox.set_output_memo(toolbox.OutputMemo() if cfg.memoize_output else None)
+
+    logging.info("Initializing %s... " % submission)
+    setup_exceptions = list(setup_exceptions)
+
+    # When recording or replaying, test process calls go through the subject's transcript (a replay never runs them;
+    # with nothing recorded, each fails). The build's setup errors are replayed, too.
+    transcript = None
+    if cfg.runtime.record or cfg.runtime.replay:
+        store = toolbox.TranscriptStore(cfg.runtime.transcript_path)
+        transcript = store.subject(os.path.basename(os.path.normpath(submission)), (cfg.build.destination, submission),
+                                   cfg.runtime.replay)
+        if transcript.missing:
+            setup_exceptions.append(transcript.missing)
+        elif transcript.replaying:
+            setup_exceptions.extend(transcript.setup_exceptions)
+        else:
+            transcript.setup_exceptions = list(setup_exceptions)
+    toolbox.set_transcript(transcript)
     subject_context = None
     starting_dir = os.getcwd()
 
@@ -310,14 +862,198 @@ def prepare_and_test_submission(submission, framework_context, cfg):
 
     starting_dir = os.getcwd()
     results, exception_sets = run_suite_tests(subject_context, framework_context, cfg)
+    toolbox.set_transcript_label("shutdown")
     cfg.shutdown_subject(subject_context)
     os.chdir(starting_dir)
+    if transcript:
+        if not transcript.replaying:
+            transcript.save()
+        toolbox.set_transcript(None)
+    memo = toolbox.get_output_memo()
+    if memo:
+        logging.debug("Output memo for %s: %d hits, %d misses\n" % (submission, memo.hits, memo.misses))
+        toolbox.set_output_memo(None)
     if len(setup_exceptions) > 0:
         exception_sets["Setup"] = setup_exceptions
 
     return results, exception_sets
 
 
+# For each submission, copy the base files, then the submission, into the destination folder; build and test it.
+def prepare_and_test_submission(submission, framework_context, cfg, log_queue=None):
+    setup_exceptions = prepare_submission(submission, cfg, log_queue)
+    if setup_exceptions is None:
+        return None
+    return test_submission(submission, framework_context, cfg, setup_exceptions, log_queue)
+
+
+# Writes a submission's results file and adds it to the summary.
+def save_submission_results(submission, suite_results, cfg, summary_path):
+    submission_info = os.path.basename(submission).split("_", 1)
+    student_name, lms_id = submission_info + ["NONE"] * (2 - len(submission_info))
+    output_dir = os.path.join(cfg.general.result_path, os.path.basename(submission))
+
+    # Generate and save individual test score information to results file.
+    grand_total = 0.0
+
+    file_data = [["Scores for %s (LMS ID: %s)..." % (student_name, lms_id)]]
+
+    if suite_results:
+        for name, result, data_set in suite_results:
+            file_data.extend([[]] + data_set + [["Set Total: %.3f" % result]])
+            grand_total += result
+
+    file_data.extend([[], ["Overall Score: %.2f" % grand_total]])
+    toolbox.save_csv(os.path.join(output_dir, cfg.general.result_file), file_data)
+
+    # Add data to summary file for this submission.
+    try:
+        toolbox.append_csv(summary_path, [[student_name, lms_id, grand_total]])
+    except:
+        # Fail silently; we should have already detected the error when creating the file.
+        pass
+
+
+class SubmissionPipeline:
+    """Schedules submissions through the build stage, a bounded hand-off queue, and the test stage; each stage has its
+    own pool, so submissions are built while earlier ones are being tested"""
+    def __init__(self, framework_context, cfg, log_queue, build_jobs=1, test_jobs=1, ready_size=1, overlap=False,
+                 monitor=None):
+        self.framework_context = framework_context
+        self.monitor = monitor
+        self.cfg = cfg
+        self.log_queue = log_queue
+        self.build_jobs = max(build_jobs, 1)
+        self.test_jobs = max(test_jobs, 1)
+        self.ready_size = max(ready_size, 0)
+        self.overlap = overlap
+
+        # Overlapping stages would rebuild a submission's files while it is tested, unless each slot has its own copy.
+        if overlap and not stages_isolated(cfg):
+            logging.warning("WARNING: subject paths aren't inside the build destination; submissions will be built and "
+                            "tested one at a time.\n")
+            self.overlap = False
+
+        exec_class = pools.ThreadPool if cfg.runtime.threaded else pools.ProcessPool
+        self.build_pool = exec_class(self.build_jobs, id="herp-build")
+        self.test_pool = exec_class(self.test_jobs, id="herp-test")
+
+        # Each submission in flight has its own staging slot (build destination) until it has been tested.
+        self._slot_count = self.build_jobs + self.ready_size + self.test_jobs
+        self._free_slots = list(range(self._slot_count))
+        self._building = []
+        self._ready = collections.deque()
+        self._testing = []
+
+
+    # Runs every submission through the pipeline, yielding (submission, result, error) as each finishes testing; result
+    # is the test stage's (suite results, exception sets) and error is an exception (with its trace) from either stage.
+    # The start callback is called for each submission before it enters the pipeline.
+    def run(self, submissions, start=None):
+        submissions = iter(submissions)
+        remaining = True
+
+        try:
+            while remaining or self._building or self._ready or self._testing:
+                # Start builds while there are build workers and room in the hand-off queue for what they will produce.
+                # Without overlap, one submission at a time goes through both stages.
+                while remaining and len(self._building) < self.build_jobs and \
+                      len(self._building) + len(self._ready) < self.build_jobs + self.ready_size and \
+                      (self.overlap or not (self._building or self._ready or self._testing)):
+                    submission = next(submissions, None)
+                    if submission is None:
+                        remaining = False
+                        break
+                    if start:
+                        start(submission)
+                    slot = self._free_slots.pop(0)
+                    stage_cfg = get_stage_config(self.cfg, slot)
+                    future = self.build_pool.apipe(run_profiled, "build", self.cfg.runtime.profile_dir,
+                                                   prepare_submission, submission, stage_cfg, self.log_queue)
+                    self._building.append((submission, slot, stage_cfg, future, time.monotonic()))
+                    self._observe("submissions_started")
+
+                # Hand off finished builds (in order, so results come out roughly in submission order).
+                while self._building and self._building[0][3].ready():
+                    submission, slot, stage_cfg, future, start_time = self._building.pop(0)
+                    self._observe("build_seconds", time.monotonic() - start_time)
+                    try:
+                        setup_exceptions = future.get()
+                        if setup_exceptions is None:
+                            raise FileNotFoundError("submission folder %s not found" % submission)
+                        self._ready.append((submission, slot, stage_cfg, setup_exceptions))
+                        self._observe("ready_queue_depth", len(self._ready))
+                    except Exception as e:
+                        self._free_slots.append(slot)
+                        self._finish(failed=True)
+                        yield submission, None, (e, traceback.format_exc())
+
+                # Start tests on built submissions.
+                while self._ready and len(self._testing) < self.test_jobs:
+                    submission, slot, stage_cfg, setup_exceptions = self._ready.popleft()
+                    self._observe("ready_queue_depth", len(self._ready))
+                    future = self.test_pool.apipe(run_profiled, "test", self.cfg.runtime.profile_dir, test_submission,
+                                                  submission, self.framework_context, stage_cfg, setup_exceptions,
+                                                  self.log_queue)
+                    self._testing.append((submission, slot, future))
+
+                # Report finished tests.
+                for entry in [entry for entry in self._testing if entry[2].ready()]:
+                    self._testing.remove(entry)
+                    submission, slot, future = entry
+                    self._free_slots.append(slot)
+                    try:
+                        result = future.get()
+                        self._finish(failed="Setup" in result[1])
+                        yield submission, result, None
+                    except Exception as e:
+                        self._finish(failed=True)
+                        yield submission, None, (e, traceback.format_exc())
+
+                self._observe("building", len(self._building))
+                self._observe("ready_queue", len(self._ready))
+                self._observe("testing", len(self._testing))
+                if self.monitor:
+                    self.monitor.update()
+
+                # Wait for something to finish.
+                in_flight = [entry[3] for entry in self._building] + [entry[2] for entry in self._testing]
+                if in_flight and not any(future.ready() for future in in_flight):
+                    in_flight[0].wait(PIPELINE_POLL_INTERVAL)
+
+        finally:
+            self.close()
+            # Remove the extra staging folders (the configured destination is left in place, as with a single slot).
+            for slot in range(1, self._slot_count):
+                stage_destination = get_stage_config(self.cfg, slot).build.destination
+                if stage_destination and os.path.isdir(stage_destination):
+                    shutil.rmtree(stage_destination)
+
+
+    # Shuts down both pools (stopping any work still in flight, if grading was interrupted) and removes them from
+    # pathos' pool cache, so later pipelines get new workers.
+    def close(self):
+        in_flight = self._building or self._ready or self._testing
+        for pool in [self.build_pool, self.test_pool]:
+            if in_flight:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+            pool.clear()
+
+
+    def _observe(self, name, value=1):
+        if self.monitor:
+            self.monitor.observe(name, value)
+
+
+    def _finish(self, failed):
+        self._observe("submissions_completed")
+        if failed:
+            self._observe("submissions_failed")
+
+
 def main():
     dill.settings['recurse']=True
     runtime = parse_arguments()
@@ -345,15 +1081,25 @@ def main():
         os.mkdir(cfg.general.result_path)
     summary_path = os.path.join(cfg.general.result_path, cfg.general.summary_file)
 
-    # Set up logging.
+    # Set up logging. Records from every worker are queued and routed by a single listener thread in this process.
     console_logger = toolbox.SelectiveStreamHandler(INFO=cfg.runtime.INFO, WARNING=cfg.runtime.WARN, CRITICAL=True)
-    logging.basicConfig(format=cfg.runtime.logformat, level=logging.DEBUG, handlers=[console_logger])
-    root_logger = logging.getLogger('')
+    console_logger.setFormatter(logging.Formatter(cfg.runtime.logformat))
     console_logger.terminator = ""
 
+    log_queue = queue.Queue() if cfg.runtime.threaded else pathos.helpers.mp.Manager().Queue()
+    # Progress is tracked by the scheduler (and by workers, through the log queue); its status goes to the console.
+    monitor = None
+    if cfg.runtime.progress or cfg.runtime.metrics_file or cfg.runtime.metrics_port is not None:
+        monitor = toolbox.ProgressMonitor(metrics_file=cfg.runtime.metrics_file, metrics_port=cfg.runtime.metrics_port,
+                                          interval=cfg.runtime.progress or 10.0)
+
+    log_router = toolbox.SubmissionLogRouter(log_queue, console_logger, monitor)
+    log_router.start()
+    if monitor and cfg.runtime.progress:
+        monitor.report = log_router.status
+
     logfile = os.path.join(cfg.general.result_path, cfg.general.error_log)
-    file_logger = toolbox.SelectiveFileHandler(logfile, mode="w", DEBUG=cfg.runtime.DEBUG, ERROR=True)
-    root_logger.addHandler(file_logger)
+    log_router.open_log(None, logfile, mode="w", DEBUG=cfg.runtime.DEBUG, ERROR=True)
 
     # Write header for summary file.
     try:
@@ -370,73 +1116,92 @@ def main():
 #        except Exception as e:
 #            sys.stderr.write("Error initializing framework - %s: %s. Exiting.\n" % (type(e).__name__, e))
 #            exit()
-    framework_context = prepare_and_init_framework(cfg)
-
-    # Close general log file and move on to student-specific logs.
-    root_logger.removeHandler(file_logger)
-    file_logger.close()
-
-    # Prepare and run each submission.
-    for submission in glob.glob(os.path.join(cfg.runtime.target_path, cfg.runtime.set)):
-        submission_info = os.path.basename(submission).split("_", 1)
-        student_name, lms_id = submission_info + ["NONE"] * (2 - len(submission_info))
-        output_dir = os.path.join(cfg.general.result_path, os.path.basename(submission))
-
-        if not os.path.isdir(output_dir):
-            os.mkdir(output_dir)
-
-        logfile = os.path.join(output_dir, cfg.general.error_log)
-        file_logger = toolbox.SelectiveFileHandler(logfile, mode="w", DEBUG=cfg.runtime.DEBUG, ERROR=True)
-        root_logger.addHandler(file_logger)
-
-        exec_class = pools.ThreadPool if cfg.runtime.threaded else pools.ProcessPool
-        with exec_class() as executor:
-            try:
-                future = executor.apipe(prepare_and_test_submission, submission, framework_context, cfg)
-                suite_results, exception_sets = future.get()
+    if cfg.runtime.profile:
+        cfg.runtime.profile_dir = os.path.join(cfg.general.result_path, "profile")
+        if os.path.isdir(cfg.runtime.profile_dir):
+            shutil.rmtree(cfg.runtime.profile_dir)
+        os.makedirs(cfg.runtime.profile_dir)
+
+    # Recorded transcripts are stored with the results unless another location is given.
+    if cfg.runtime.record or cfg.runtime.replay:
+        cfg.runtime.transcript_path = cfg.runtime.transcripts or os.path.join(os.path.abspath(cfg.general.result_path),
+                                                                              "transcripts")
+        logging.info("%s transcripts in %s.\n" % ("Replaying" if cfg.runtime.replay else "Recording",
+                                                  cfg.runtime.transcript_path))
+
+    # Host a jobserver, if requested, so concurrent builds share one budget of job slots.
+    jobs = cfg.runtime.jobs or cfg.build.jobs
+    if jobs:
+        cfg.runtime.jobserver = toolbox.Jobserver(jobs)
+
+    # Data the framework publishes for workers (and the jobserver) is released however grading ends.
+    try:
+        framework_context = run_profiled("framework", cfg.runtime.profile_dir, prepare_and_init_framework, cfg)
+
+        # Calibrate timeouts (if configured) before grading; the table goes to workers with the configuration.
+        cfg.timeouts = calibrate_timeouts(cfg, framework_context, log_queue)
+
+        # Close general log file and move on to student-specific logs.
+        log_router.close_log(None)
+
+        # Prepare and run each submission. With --overlap, submissions are built (build pool) while earlier ones are
+        # tested (test pool), and at most ready_queue built submissions wait between the two; otherwise (and always in
+        # threaded mode, as threads share a working directory) the stages take turns.
+        pipeline = SubmissionPipeline(framework_context, cfg, log_queue, cfg.runtime.build_jobs, cfg.runtime.test_jobs,
+                                      cfg.runtime.ready_queue, overlap=cfg.runtime.overlap and not cfg.runtime.threaded,
+                                      monitor=monitor)
+
+        # (Submissions from an archive arrive as they are extracted, so their total isn't known in advance.)
+        submissions = get_submissions(cfg)
+        if not cfg.runtime.archive:
+            submissions = list(submissions)
+            if monitor:
+                monitor.observe("submissions_total", len(submissions))
+
+        def start_submission(submission):
+            submission_id = os.path.basename(submission)
+            output_dir = os.path.join(cfg.general.result_path, submission_id)
+            if not os.path.isdir(output_dir):
+                os.mkdir(output_dir)
+
+            logfile = os.path.join(output_dir, cfg.general.error_log)
+            log_router.open_log(submission_id, logfile, mode="w", DEBUG=cfg.runtime.DEBUG, ERROR=True)
+
+        for submission, result, error in pipeline.run(submissions, start_submission):
+            submission_id = os.path.basename(submission)
+            toolbox.set_log_submission(submission_id)
+
+            if error:
+                e, stack_trace = error
+                logging.error("Error preparing / running %s - %s: %s\n%s" %
+                              (submission, type(e).__name__, e, stack_trace))
+            else:
+                suite_results, exception_sets = result
                 # If there were exceptions in the tests, we should log them.
                 for project, exception_list in exception_sets.items():
                    if len(exception_list) > 0:
                        log_header = "Exceptions for %s\n%s\n" % (project, "-"*(15 + len(project)))
                        logging.error(log_header + "\n".join(exception_list))
-            except Exception as e:
-                stack_trace = traceback.format_exc()
-                logging.error("Error preparing / running %s - %s: %s\n%s" % (submission, type(e).__name__, e, stack_trace))
-                root_logger.removeHandler(file_logger)
-                file_logger.close()
-#                executor.terminate()
-#                executor.join()
-                continue
-
-#            executor.terminate()
-#            executor.join()
 
-        # Generate and save individual test score information to results file.
-        grand_total = 0.0
+                save_submission_results(submission, suite_results, cfg, summary_path)
 
-        file_data = [["Scores for %s (LMS ID: %s)..." % (student_name, lms_id)]]
+            log_router.close_log(submission_id)
+            toolbox.set_log_submission(None)
 
-        if suite_results:
-            for name, result, data_set in suite_results:
-                file_data.extend([[]] + data_set + [["Set Total: %.3f" % result]])
-                grand_total += result
-
-        file_data.extend([[], ["Overall Score: %.2f" % grand_total]])
-        toolbox.save_csv(os.path.join(output_dir, cfg.general.result_file), file_data)
-
-        # Add data to summary file for this submission.
-        try:
-            toolbox.append_csv(summary_path, [[student_name, lms_id, grand_total]])
-        except:
-            # Fail silently; we should have already detected the error when creating the file.
-            pass
-
-        root_logger.removeHandler(file_logger)
-        file_logger.close()
-        time.sleep(2)
-
-    cfg.shutdown_framework(framework_context)
+        cfg.shutdown_framework(framework_context)
+    finally:
+        toolbox.release_shared_data()
+        if cfg.runtime.jobserver:
+            cfg.runtime.jobserver.close()
     logging.info("Framework shutdown\n")
+
+    if cfg.runtime.profile_dir:
+        merge_profiles(cfg.runtime.profile_dir, os.path.join(cfg.general.result_path, "profile.pstats"),
+                       os.path.join(cfg.general.result_path, "profile.txt"), os.getcwd())
+        logging.info("Profile saved to %s\n" % os.path.join(cfg.general.result_path, "profile.txt"))
+    if monitor:
+        monitor.close()
+    log_router.stop()
     # Return to where we started at.
     os.chdir(starting_dir)
 
@@ -1,20 +1,38 @@
 import csv
 import ctypes
+import gzip
 import _ctypes
+import array
+import bisect
 import difflib
+import fcntl
 import hashlib
+import http.server
+import json
+import mmap
+import pickle
 import re
+import select
 import tempfile
 import shutil
 import os
 import sys
 import string
+import struct
 import logging
+import logging.handlers
 import collections
+import contextlib
 import itertools
 import pexpect
 import time
+import threading
 import pyte
+import resource
+import signal
+import subprocess
+import termios
+import numpy
 import traceback
 import ptyprocess
 
@@ -23,7 +41,7 @@ import importlib.util
 from ctypes import util
 from os import path
 from numbers import Number
-from subprocess import Popen, PIPE, TimeoutExpired
+from subprocess import Popen, PIPE
 
 DEFAULT_MAX_READ = 1024 * 1024
 
@@ -70,6 +88,7 @@ class SelectiveFileHandler(logging.FileHandler):
         self._WARNING = keywords.pop("WARNING", False or LOG_ALL)
         self._INFO = keywords.pop("INFO", False or LOG_ALL)
         self._DEBUG = keywords.pop("DEBUG", False or LOG_ALL)
+        self._buffered = keywords.pop("buffered", False)
         self._add_level = add_level
         logging.FileHandler.__init__(self, filename, mode, encoding, delay)
 
@@ -80,11 +99,21 @@ class SelectiveFileHandler(logging.FileHandler):
           record.levelno == logging.WARNING and self._WARNING or \
           record.levelno == logging.INFO and self._INFO or \
           record.levelno == logging.DEBUG and self._DEBUG:
-            if self._add_level:
-                record.msg = "[%s] %s" % (record.levelname, record.msg)
             logging.FileHandler.emit(self, record)
 
 
+    # Add the level to the formatted message (rather than the record, which other handlers may also see).
+    def format(self, record):
+        message = logging.FileHandler.format(self, record)
+        return "[%s] %s" % (record.levelname, message) if self._add_level else message
+
+
+    # Buffered handlers leave writes in the stream buffer; it is flushed when the handler is closed.
+    def flush(self):
+        if not self._buffered:
+            logging.FileHandler.flush(self)
+
+
 class SelectiveStreamHandler(logging.StreamHandler):
     def __init__(self, stream=None, add_level=False, **keywords):
         LOG_ALL = keywords.pop("LOG_ALL", False)
@@ -103,11 +132,286 @@ class SelectiveStreamHandler(logging.StreamHandler):
           record.levelno == logging.WARNING and self._WARNING or \
           record.levelno == logging.INFO and self._INFO or \
           record.levelno == logging.DEBUG and self._DEBUG:
-            if self._add_level:
-                record.msg = "[%s] %s" % (record.levelname, record.msg)
             logging.StreamHandler.emit(self, record)
 
 
+    def format(self, record):
+        message = logging.StreamHandler.format(self, record)
+        return "[%s] %s" % (record.levelname, message) if self._add_level else message
+
+
+##### QUEUED LOGGING #####
+_log_queue_handler = None
+
+
+# Sets the submission that log records from the current thread belong to (None for general records). This is kept on
+# the thread itself rather than in a threading.local, which can't be pickled along with this module for workers.
+def set_log_submission(submission):
+    threading.current_thread().log_submission = submission
+
+
+class SubmissionLogFilter(logging.Filter):
+    """Filter that tags each record with the submission currently set for the logging thread"""
+    def filter(self, record):
+        if not hasattr(record, "submission"):
+            record.submission = getattr(threading.current_thread(), "log_submission", None)
+        return True
+
+
+# Sends all records logged in this process to the log queue (tagged with their submission). Safe to call repeatedly.
+def attach_log_queue(log_queue):
+    global _log_queue_handler
+    root_logger = logging.getLogger('')
+    if _log_queue_handler in root_logger.handlers:
+        return
+
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+
+    _log_queue_handler = logging.handlers.QueueHandler(log_queue)
+    _log_queue_handler.addFilter(SubmissionLogFilter())
+    root_logger.addHandler(_log_queue_handler)
+    root_logger.setLevel(logging.DEBUG)
+
+
+# Reports a metric observation (e.g., a test's duration) from any worker to the run's ProgressMonitor. Observations
+# travel through the log queue with the records around them; without a queue (or monitor), they are dropped.
+def record_metric(name, value=1):
+    if _log_queue_handler is not None:
+        _log_queue_handler.queue.put_nowait(logging.makeLogRecord({"metric": (name, value)}))
+
+
+class SubmissionLogRouter(logging.Handler):
+    """Handler run by a single listener thread that routes queued records to the console and per-submission logs"""
+    def __init__(self, log_queue, console=None, monitor=None):
+        logging.Handler.__init__(self)
+        self.queue = log_queue
+        self.console = console
+        self.monitor = monitor
+        self._files = {}
+        self._listener = logging.handlers.QueueListener(log_queue, self)
+
+
+    def start(self):
+        attach_log_queue(self.queue)
+        self._listener.start()
+
+
+    # Stops the listener (after it processes every queued record) and closes any open log files.
+    def stop(self):
+        self._listener.stop()
+        for handler in self._files.values():
+            handler.close()
+        self._files = {}
+
+
+    # Open / close requests travel through the queue so they are ordered with the records around them.
+    def open_log(self, submission, filename, **keywords):
+        self.queue.put_nowait(logging.makeLogRecord({"log_control": ("open", submission, filename, keywords)}))
+
+
+    def close_log(self, submission):
+        self.queue.put_nowait(logging.makeLogRecord({"log_control": ("close", submission, None, None)}))
+
+
+    # Sends a line to the console, ordered with the records around it (but not to any log file).
+    def status(self, line):
+        self.queue.put_nowait(logging.makeLogRecord({"msg": line, "levelno": logging.INFO, "levelname": "INFO",
+                                                     "submission": "[status]"}))
+
+
+    def emit(self, record):
+        metric = getattr(record, "metric", None)
+        if metric:
+            if self.monitor:
+                self.monitor.observe(*metric)
+            return
+
+        control = getattr(record, "log_control", None)
+        if control:
+            action, submission, filename, keywords = control
+            if submission in self._files:
+                self._files.pop(submission).close()
+            if action == "open":
+                self._files[submission] = SelectiveFileHandler(filename, buffered=True, **keywords)
+            return
+
+        if self.console:
+            self.console.handle(record)
+
+        file_handler = self._files.get(getattr(record, "submission", None))
+        if file_handler:
+            file_handler.handle(record)
+
+
+##### PROGRESS / METRICS #####
+# Histogram bucket upper bounds: build and per-test durations (seconds) and hand-off queue depth (submissions).
+BUILD_SECONDS_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+TEST_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+QUEUE_DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32)
+
+# Metric names, types, and descriptions (for the Prometheus text format).
+_PROGRESS_COUNTERS = {
+    "submissions_started": "Submissions that have entered the build stage",
+    "submissions_completed": "Submissions that have finished testing (or failed)",
+    "submissions_failed": "Submissions that failed to build, initialize, or run",
+    "test_timeouts": "Test processes (get_cmd_output / get_py_output) killed after their timeout; get_vt_output read "
+                     "timeouts are not counted, as they are how interactive runs normally end",
+    "limit_violations": "Test / build processes that exceeded a resource limit",
+}
+_PROGRESS_GAUGES = {
+    "submissions_total": "Submissions to be tested (if known)",
+    "building": "Submissions currently being built",
+    "ready_queue": "Built submissions waiting to be tested",
+    "testing": "Submissions currently being tested",
+}
+_PROGRESS_HISTOGRAMS = {
+    "build_seconds": ("Time to stage and build a submission", BUILD_SECONDS_BUCKETS),
+    "test_seconds": ("Time to run one test case", TEST_SECONDS_BUCKETS),
+    "ready_queue_depth": ("Hand-off queue depth, observed as submissions enter and leave it", QUEUE_DEPTH_BUCKETS),
+}
+
+
+class Histogram:
+    """Latency / size histogram with cumulative buckets, as in the Prometheus text format"""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def exposition(self, name):
+        lines = []
+        for bound, total in zip(self.buckets + ("+Inf",), itertools.accumulate(self.counts)):
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, total))
+        lines.append("%s_sum %s" % (name, repr(float(self.sum))))
+        lines.append("%s_count %d" % (name, self.count))
+        return lines
+
+
+class ProgressMonitor:
+    """Tracks a grading run: counts, throughput, ETA, and histograms. Reports a status line (through report) and
+    exports the metrics in the Prometheus text format to a file and / or a localhost HTTP port"""
+    def __init__(self, total=None, report=None, metrics_file=None, metrics_port=None, interval=10.0, prefix="herp"):
+        self.report = report
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.prefix = prefix
+        self.counters = dict.fromkeys(_PROGRESS_COUNTERS, 0)
+        self.gauges = dict.fromkeys(_PROGRESS_GAUGES, 0)
+        self.gauges["submissions_total"] = total
+        self.histograms = {name: Histogram(buckets) for name, (_, buckets) in _PROGRESS_HISTOGRAMS.items()}
+        self.start_time = time.monotonic()
+        self._last_update = self.start_time
+        self._lock = threading.Lock()
+        self._server = None
+
+        if metrics_port is not None:
+            self._server = http.server.ThreadingHTTPServer(("127.0.0.1", metrics_port), self._make_handler())
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+
+    # Records an observation: histograms observe the value, counters add it, and gauges are set to it.
+    def observe(self, name, value=1):
+        with self._lock:
+            if name in self.histograms:
+                self.histograms[name].observe(value)
+            elif name in self.counters:
+                self.counters[name] += value
+            elif name in self.gauges:
+                self.gauges[name] = value
+
+
+    def status_line(self):
+        with self._lock:
+            completed = self.counters["submissions_completed"]
+            total = self.gauges["submissions_total"]
+            elapsed = time.monotonic() - self.start_time
+            rate = completed / elapsed if elapsed > 0 else 0
+            line = "[progress] %d/%s done" % (completed, total if total is not None else "?")
+            line += " (%d building, %d queued, %d testing)" % (self.gauges["building"], self.gauges["ready_queue"],
+                                                               self.gauges["testing"])
+            line += " | %.2f/min" % (rate * 60)
+            if total is not None and rate > 0:
+                line += " | ETA %s" % _format_duration((total - completed) / rate)
+            line += " | failed: %d, timeouts: %d" % (self.counters["submissions_failed"], self.counters["test_timeouts"])
+            return line
+
+
+    def exposition(self):
+        with self._lock:
+            lines = []
+            for name, description in _PROGRESS_COUNTERS.items():
+                lines += ["# HELP %s_%s_total %s" % (self.prefix, name, description),
+                          "# TYPE %s_%s_total counter" % (self.prefix, name),
+                          "%s_%s_total %d" % (self.prefix, name, self.counters[name])]
+            for name, description in _PROGRESS_GAUGES.items():
+                if self.gauges[name] is not None:
+                    lines += ["# HELP %s_%s %s" % (self.prefix, name, description),
+                              "# TYPE %s_%s gauge" % (self.prefix, name),
+                              "%s_%s %d" % (self.prefix, name, self.gauges[name])]
+            for name, (description, _) in _PROGRESS_HISTOGRAMS.items():
+                lines += ["# HELP %s_%s %s" % (self.prefix, name, description),
+                          "# TYPE %s_%s histogram" % (self.prefix, name)]
+                lines += self.histograms[name].exposition("%s_%s" % (self.prefix, name))
+            return "\n".join(lines) + "\n"
+
+
+    # Reports status and writes the metrics file, if the interval has passed since the last update (or if forced).
+    def update(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_update < self.interval:
+            return
+        self._last_update = now
+
+        if self.report:
+            self.report(self.status_line() + "\n")
+        if self.metrics_file:
+            with tempfile.NamedTemporaryFile(mode="w", dir=path.dirname(path.abspath(self.metrics_file)),
+                                             delete=False) as tmp_file:
+                tmp_file.write(self.exposition())
+            os.replace(tmp_file.name, self.metrics_file)
+
+
+    def close(self):
+        self.update(force=True)
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+    def _make_handler(self):
+        monitor = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = monitor.exposition().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return MetricsHandler
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
 def data_to_file(data, filename):
     with open(filename, 'wb+') as my_file:
         my_file.write(data)
@@ -169,7 +473,141 @@ def is_file(filename):
         return None
 
 
+##### LIBRARY RESOLUTION #####
+_ELF_MAGIC = b'\x7fELF'
+_ELF_TYPE_SHARED = 3
+_ELF_SECTION_DYNAMIC = 6
+_ELF_TAG_NULL = 0
+_ELF_TAG_SONAME = 14
+
+# Per-class (32 / 64 bit) struct layouts: ELF header (after e_ident), section header, and dynamic entry.
+_ELF_LAYOUTS = {1: ("HHIIIIIHHHHHH", "IIIIIIIIII", "iI"),
+                2: ("HHIQQQIHHHHHH", "IIQQQQIIQQ", "qQ")}
+
+# Platform-specific library suffixes, in the order they should be tried.
+_LIBRARY_SUFFIXES = ('.so', '.dylib') if sys.platform == 'darwin' else ('.so', '.dll') if os.name == 'nt' else ('.so',)
+
+_library_indexes = {}
+
+
+# Returns the ELF file type and SONAME (or None) of an ELF file, or None if the file is not an ELF file.
+def _read_elf_info(filename):
+    try:
+        with open(filename, 'rb') as elf:
+            ident = elf.read(16)
+            if len(ident) < 16 or ident[:4] != _ELF_MAGIC or ident[4] not in _ELF_LAYOUTS:
+                return None
+
+            byte_order = '<' if ident[5] == 1 else '>'
+            header_fmt, section_fmt, dynamic_fmt = (byte_order + fmt for fmt in _ELF_LAYOUTS[ident[4]])
+            header = struct.unpack(header_fmt, elf.read(struct.calcsize(header_fmt)))
+            elf_type, section_offset, section_size, section_count = header[0], header[5], header[10], header[11]
+            if not section_offset or not section_count:
+                return elf_type, None
+
+            # Grab the section headers, then find the dynamic section and its associated string table.
+            elf.seek(section_offset)
+            table = elf.read(section_size * section_count)
+            sections = [struct.unpack_from(section_fmt, table, index * section_size) for index in range(section_count)]
+
+            for section in sections:
+                if section[1] != _ELF_SECTION_DYNAMIC or section[6] >= section_count:
+                    continue
+
+                elf.seek(section[4])
+                dynamic = elf.read(section[5])
+                strings = sections[section[6]]
+                for tag, value in struct.iter_unpack(dynamic_fmt, dynamic[:len(dynamic) - len(dynamic) % struct.calcsize(dynamic_fmt)]):
+                    if tag == _ELF_TAG_NULL:
+                        break
+                    elif tag == _ELF_TAG_SONAME:
+                        elf.seek(strings[4] + value)
+                        return elf_type, elf.read(256).split(b'\0', 1)[0].decode(errors='replace')
+
+            return elf_type, None
+    except (OSError, struct.error):
+        return None
+
+
+class LibraryIndex:
+    """Index of the libraries in a directory (and its immediate subdirectories) by filename and ELF SONAME"""
+    def __init__(self, directory):
+        self.directory = path.abspath(directory)
+        self.scan()
+
+
+    def scan(self):
+        self._files = {}
+        self._sonames = {}
+        self._stamps = {}
+
+        for folder in [self.directory] + self._subdirectories(self.directory):
+            try:
+                self._stamps[folder] = os.stat(folder).st_mtime_ns
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+
+                # Index every file by relative path so the classic name probes still resolve (lib, so, etc).
+                self._files[path.relpath(entry.path, self.directory)] = entry.path
+                elf_info = _read_elf_info(entry.path)
+                if elf_info and elf_info[0] == _ELF_TYPE_SHARED:
+                    self._sonames.setdefault(elf_info[1] or entry.name, entry.path)
+
+
+    # Returns true if any scanned folder has changed (or disappeared) since the last scan.
+    def is_stale(self):
+        try:
+            return not self._stamps or any(os.stat(folder).st_mtime_ns != stamp for folder, stamp in self._stamps.items())
+        except OSError:
+            return True
+
+
+    # Returns the path to a matching library (or None) using the same name probes as the system search.
+    def find(self, name):
+        candidates = [name, path.join(name, name), "lib" + name, path.join(name, "lib" + name)]
+        for suffix in _LIBRARY_SUFFIXES:
+            candidates += ["lib" + name + suffix, path.join(name, "lib" + name + suffix)]
+
+        for candidate in candidates:
+            if candidate in self._files:
+                return self._files[candidate]
+
+        # Fall back to SONAMEs, which may carry version suffixes (e.g., libfoo.so.1).
+        soname_prefix = "lib" + name + ".so."
+        for soname, filename in self._sonames.items():
+            if soname == name or soname == "lib" + name + ".so" or soname.startswith(soname_prefix):
+                return filename
+        return None
+
+
+    @staticmethod
+    def _subdirectories(directory):
+        try:
+            return sorted(entry.path for entry in os.scandir(directory) if entry.is_dir())
+        except OSError:
+            return []
+
+
+# Returns the (cached) library index for a directory, rescanning it if it has changed since it was last indexed.
+def get_library_index(directory):
+    key = path.abspath(directory)
+    index = _library_indexes.get(key)
+    if not index or index.is_stale():
+        index = _library_indexes[key] = LibraryIndex(key)
+    return index
+
+
 def find_library(directory, name):
+    return get_library_index(directory).find(name) or _find_system_library(directory, name)
+
+
+# Probes the system library search (this can spawn ldconfig / gcc / ld on Linux, so it is only used on index misses).
+def _find_system_library(directory, name):
     result = (util.find_library(path.join(directory, name)) or
               util.find_library(path.join(directory, name, name)) or
               util.find_library(path.join(directory, "lib" + name)) or
@@ -233,107 +671,60 @@ def sed(filename, pattern, repl):
     shutil.move(tmp_file.name, filename)
 
 
-# NOTE: If avoid_collisions is True, returns non-CP437 box characters to avoid collisions with 8-bit encodings.
-def convert_curses_capture(capture, text_only=False, box_only=False, avoid_collisions=False):
-    converted = []
-    box_chars = "┍┑┕┙━┃" if avoid_collisions else "┌┐└┘─│"
-    pattern = re.compile("((lq+k)|(mqq+j)|(qqqqq+))") # Matches strings that are likely boxes (don't occur in language)
-    curses_to_box = str.maketrans("lkmjqx", box_chars) # These are stand-in chars and cannot occur in CP437.
-#    box_to_cp437 = str.maketrans(box_chars, "┌┐└┘─│") # Convert non-CP437 variant to CP437 variant. (Needed?)
-#    box_to_space = str.maketrans(box_chars,"      ") # Convert boxes to spaces (Needed?)
-
-    # Find matches to known box sequences.
-    matches = [(line, [match.span() for match in pattern.finditer(line)]) for line in capture]
-
-    for line, match_set in matches:
-        next = 0
-        line_set = []
-        for start, end in match_set:
-            # If there are any characters before the match that we haven't added yet to our string set, add them now.
-            if start != next:
-                line_set.append(line[next:start])
-
-            # Convert to analogous (but not identical) box characters; these variants do not occur in CP437.
-            line_set.append(line[start:end].translate(curses_to_box))
-            next = end
-
-        if next != len(line):
-            line_set.append(line[next:])
-        converted.append("".join(line_set))
-
-    # Next, find characters that might be matches, and triangulate using already converted characters.
-    pattern = re.compile("[lkmjqx]")
-    matches = [[match.span() for match in pattern.finditer(line)] for line in converted]
-    for line_no, match_set in enumerate(matches):
-        line = converted[line_no]
-        next = 0
-        line_set = []
-        for index, _ in match_set:
-        # If there are any characters before the match that we haven't added yet to our string set, add them now.
-            if index != next:
-                line_set.append(line[next:index])
-
-            if line[index] == "l":
-                if len(line) > index+1 and line[index+1] == "━":
-                    line_set.append("┍")
-                elif len(converted) < line_no+1 and len(converted[line_no+1]) > index and converted[line_no+1][index] == "┃":
-                    line_set.append("┍")
-                else:
-                    line_set.append("l")
+##### CURSES / LINE DRAWING #####
+# DEC special graphics (line drawing) characters and their box-drawing glyphs; the alternate (non-CP437) variants
+# avoid collisions with 8-bit encodings.
+_DEC_LINE_DRAWING = "lkmjqxtuvwn"
+_BOX_CHARS = "┌┐└┘─│├┤┴┬┼"
+_BOX_CHARS_ALT = "┍┑┕┙━┃┝┥┷┯┿"
 
-            elif line[index] == "k":
-                if index > 0 and line[index-1] == "━":
-                    line_set.append("┑")
-                elif len(converted) < line_no+1 and len(converted[line_no+1]) > index and converted[line_no+1][index] == "┃":
-                    line_set.append("┑")
-                else:
-                    line_set.append("k")
+_TO_BOX = str.maketrans(_BOX_CHARS_ALT, _BOX_CHARS)
+_TO_BOX_ALT = str.maketrans(_BOX_CHARS, _BOX_CHARS_ALT)
+_BOX_TO_SPACE = str.maketrans(_BOX_CHARS + _BOX_CHARS_ALT, " " * (len(_BOX_CHARS) + len(_BOX_CHARS_ALT)))
+_NOT_BOX = re.compile("[^%s]" % (_BOX_CHARS + _BOX_CHARS_ALT))
 
-            elif line[index] == "m":
-                if len(line) > index+1 and line[index+1] == "━":
-                    line_set.append("┕")
-                elif line_no > 0 and len(converted[line_no-1]) > index and converted[line_no-1][index] == "┃":
-                    line_set.append("┕")
-                else:
-                    line_set.append("m")
 
-            elif line[index] == "j":
-                if index > 0 and line[index-1] == "━":
-                    line_set.append("┙")
-                elif line_no > 0 and len(converted[line_no-1]) > index and converted[line_no-1][index] == "┃":
-                    line_set.append("┙")
-                else:
-                    line_set.append("j")
+# Returns a pyte charset map (VT100 graphics) that decodes the DEC line drawing characters to the given box glyphs.
+def _line_drawing_charset(box_chars):
+    charset = list(pyte.charsets.VT100_MAP)
+    for dec_char, box_char in zip(_DEC_LINE_DRAWING, box_chars):
+        charset[ord(dec_char)] = box_char
+    return "".join(charset)
 
-            elif line[index] == "q":
-                if index > 0 and (line[index-1] == "━" or line[index-1] == "┕" or line[index-1] == "┍"):
-                    line_set.append("━")
-                elif len(line) > index+1 and (line[index+1] == "━" or line[index+1] == "┙" or line[index+1] == "┑"):
-                    line_set.append("━")
-                else:
-                    line_set.append("q")
 
-            elif line[index] == "x":
-                if line_no > 0 and len(converted[line_no-1]) > index and (converted[line_no-1][index] == "┃" or converted[line_no-1][index] == "┍" or converted[line_no-1][index] == "┑"):
-                    line_set.append("┃")
-                elif len(converted) > line_no+1 and len(converted[line_no+1]) > index and (converted[line_no+1][index] == "┃" or converted[line_no+1][index] == "┕" or converted[line_no+1][index] == "┙"):
-                    line_set.append("┃")
-                else:
-                    line_set.append("x")
+_LINE_DRAWING_CHARSETS = {False: _line_drawing_charset(_BOX_CHARS), True: _line_drawing_charset(_BOX_CHARS_ALT)}
+
+
+class _LineDrawingScreen(pyte.Screen):
+    """pyte screen that tracks G0 / G1 charsets, decoding DEC line drawing characters as box glyphs as they are fed"""
+    def __init__(self, columns, lines, avoid_collisions=False):
+        self._line_drawing = _LINE_DRAWING_CHARSETS[avoid_collisions]
+        super().__init__(columns, lines)
+
+
+    def define_charset(self, code, mode):
+        if code == "0" and mode == "(":
+            self.g0_charset = self._line_drawing
+        elif code == "0" and mode == ")":
+            self.g1_charset = self._line_drawing
+        else:
+            super().define_charset(code, mode)
+
 
-            next = index + 1
+# Converts box-drawing characters in a screen capture (decoded by the virtual terminal) to the requested variant.
+# NOTE: If avoid_collisions is True, returns non-CP437 box characters to avoid collisions with 8-bit encodings.
+def convert_curses_capture(capture, text_only=False, box_only=False, avoid_collisions=False):
+    if isinstance(capture, str):
+        capture = capture.splitlines()
 
-        # Finish construction of final line (if necessary) and merge lines into single string again.
-        if next != len(line):
-            line_set.append(line[next:])
-        converted[line_no] = "".join(line_set)
+    # If flags set, grab either only the text or only the box characters.
+    if text_only:
+        return [line.translate(_BOX_TO_SPACE) for line in capture]
 
-        # If flags set, grab either only the text or only the box characters.
-        if text_only:
-            converted = "".join([" " if character in box_chars else character for character in converted])
-        elif box_only:
-            converted = "".join([character if character in box_chars else " " for character in converted])
-    return converted
+    table = _TO_BOX_ALT if avoid_collisions else _TO_BOX
+    if box_only:
+        return [_NOT_BOX.sub(" ", line).translate(table) for line in capture]
+    return [line.translate(table) for line in capture]
 
 
 def causes_exception(test_me):
@@ -461,39 +852,49 @@ def _convert_type(targetType, value):
         return None
 
 
+# Tokenizer tables: punctuation (except radix and hyphen/minus) becomes whitespace; radix / hyphen split non-numbers.
+_TOKEN_PUNCTUATION = string.punctuation.translate(str.maketrans('', '', '.-'))
+_PUNC_TO_SPACE = str.maketrans(_TOKEN_PUNCTUATION, " " * len(_TOKEN_PUNCTUATION))
+_RADIX_DASH_TO_SPACE = str.maketrans('.-', '  ')
+_FLOAT_WORDS = frozenset(("inf", "infinity", "nan"))
+
+
 def parse_tokens(input, is_case_sensitive=False, number_string_match=False):
-    lines = input.splitlines()
-    output = []
-    tokens = []
-
-    for line in lines:
-        # Get a list of punctuation marks except radix and hyphen/minus so we can remove them.
-        punctuation = string.punctuation.translate(str.maketrans('', '', '.-'))
-        punc_to_space = str.maketrans(punctuation, " " * len(punctuation))
-        radix_dash_to_space = str.maketrans('.-', '  ')
-
-        if not is_case_sensitive:
-            line = line.lower()
-
-        for token in line.strip().translate(punc_to_space).split():
-            token = token.strip()
-            # If this isn't a float, replace periods with space.
-            if _convert_type(float, token) == None:
-                tokens += [entry.strip() for entry in token.translate(radix_dash_to_space).split()]
-            else:
-                if number_string_match:
-                  tokens += [token]
-                else:
-                  if round(float(token)) == float(token):
-                    tokens += [str(round(float(token)))]
-                  else:
-                    tokens += [str(float(token))]
+    return list(iter_tokens(input, is_case_sensitive, number_string_match))
+
+
+# Generates the token list of each (non-empty) line; input may be a string or a text stream / iterable of lines.
+def iter_tokens(input, is_case_sensitive=False, number_string_match=False):
+    chunks = input.splitlines() if isinstance(input, str) else input
+
+    for chunk in chunks:
+        # Stream lines may still contain separators that splitlines() recognizes (e.g., form feeds), so split them too.
+        for line in (chunk,) if isinstance(input, str) else chunk.splitlines():
+            if not is_case_sensitive:
+                line = line.lower()
 
-        if tokens:
-            output.append(tokens)
             tokens = []
+            for token in line.translate(_PUNC_TO_SPACE).split():
+                # Words can't be numbers (save for a few special values), so skip the conversion attempt for them.
+                if token[0].isalpha() and token.lower() not in _FLOAT_WORDS:
+                    tokens.extend(token.translate(_RADIX_DASH_TO_SPACE).split())
+                    continue
+
+                try:
+                    value = float(token)
+                except ValueError:
+                    # If this isn't a float, replace periods with space.
+                    tokens.extend(token.translate(_RADIX_DASH_TO_SPACE).split())
+                    continue
 
-    return output
+                if number_string_match:
+                    tokens.append(token)
+                else:
+                    rounded = round(value)
+                    tokens.append(str(rounded) if rounded == value else str(value))
+
+            if tokens:
+                yield tokens
 
 
 def get_value_or_error_msg(target_function, params):
@@ -511,9 +912,708 @@ def get_type_and_value_string(target):
     return type(target).__name__ + ": " + str(target)
 
 
-def ansi_to_text(text, lines=30, columns=80):
+##### PROCESS LIMITS #####
+# Resource limits, by name: (rlimit, message patterns a violation usually produces when it isn't signaled).
+_RESOURCE_LIMITS = {
+    "memory": (resource.RLIMIT_AS, re.compile(r"MemoryError|bad_alloc|Cannot allocate memory|out of memory", re.I)),
+    "cpu_time": (resource.RLIMIT_CPU, None),
+    "processes": (resource.RLIMIT_NPROC, re.compile(r"Resource temporarily unavailable|BlockingIOError|fork: retry")),
+    "file_size": (resource.RLIMIT_FSIZE, re.compile(r"File too large")),
+    "open_files": (resource.RLIMIT_NOFILE, re.compile(r"Too many open files")),
+}
+
+# Signals sent by the kernel when a limit is hit.
+_LIMIT_SIGNALS = {signal.SIGXCPU: "cpu_time", signal.SIGXFSZ: "file_size"}
+
+# Limits are set by a small program that execs the command (see ProcessLimits.wrap): util-linux's prlimit, by option
+# name, if it's installed, or else this Python script.
+_PRLIMIT = shutil.which("prlimit")
+_PRLIMIT_OPTIONS = {"memory": "--as", "cpu_time": "--cpu", "processes": "--nproc", "file_size": "--fsize",
+                    "open_files": "--nofile"}
+_LIMIT_EXEC = ("import os, resource, sys\n"
+               "for spec in sys.argv[1].split(','):\n"
+               "    limit, soft, hard = map(int, spec.split(':'))\n"
+               "    resource.setrlimit(limit, (soft, hard))\n"
+               "try:\n"
+               "    os.execvp(sys.argv[2], sys.argv[2:])\n"
+               "except OSError as error:\n"
+               "    sys.stderr.write('%s: %s\\n' % (sys.argv[2], error.strerror))\n"
+               "    sys.exit(127)\n")
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+# Default limits for test processes in this process (see set_process_limits).
+_process_limits = None
+
+
+class ProcessLimits:
+    """Resource limits applied to a test / build process (by a wrapper that execs it); None leaves a limit as is"""
+    def __init__(self, memory=None, cpu_time=None, processes=None, file_size=None, open_files=None, output=None,
+                 output_memory=None):
+        self.memory = memory            # Address space, in bytes
+        self.cpu_time = cpu_time        # CPU time, in seconds
+        self.processes = processes      # Processes / threads (note: counted per user, not per process tree)
+        self.file_size = file_size      # Size of any file written, in bytes
+        self.open_files = open_files    # Open file descriptors
+        self.output = output            # Captured output (per stream), in bytes; the process is killed beyond it
+        self.output_memory = output_memory  # Captured output kept in memory (per stream) before spilling to disk
+
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in _RESOURCE_LIMITS if getattr(self, name) is not None]
+
+
+    # Returns the (soft, hard) limits, by name. The CPU soft limit signals (SIGXCPU) a second before the hard limit kills
+    # the process.
+    def rlimits(self):
+        return [(name, value, value + 1 if name == "cpu_time" else value) for name, value in self.items()]
+
+
+    # Applies the limits to the current process.
+    def apply(self):
+        for name, soft, hard in self.rlimits():
+            resource.setrlimit(_RESOURCE_LIMITS[name][0], (soft, hard))
+
+
+    # Returns the command wrapped so that a small program sets the limits and then execs it. (Setting them between fork
+    # and exec with preexec_fn isn't safe in a process running threads, as herp's are.)
+    def wrap(self, command):
+        command = [command] if isinstance(command, str) else [str(entry) for entry in command]
+        rlimits = self.rlimits()
+        if not rlimits:
+            return command
+        if _PRLIMIT:
+            return [_PRLIMIT] + ["%s=%d:%d" % (_PRLIMIT_OPTIONS[name], soft, hard) for name, soft, hard in rlimits] + \
+                   ["--"] + command
+        specs = ",".join("%d:%d:%d" % (_RESOURCE_LIMITS[name][0], soft, hard) for name, soft, hard in rlimits)
+        return [sys.executable, "-S", "-E", "-c", _LIMIT_EXEC, specs] + command
+
+
+    # Returns a capture buffer for one output stream of a process run under these limits.
+    def capture(self):
+        return OutputCapture(self.output if self.output is not None else DEFAULT_OUTPUT_LIMIT,
+                             self.output_memory if self.output_memory is not None else DEFAULT_CAPTURE_MEMORY)
+
+
+    def __repr__(self):
+        items = self.items() + [(name, getattr(self, name)) for name in ("output", "output_memory")
+                                if getattr(self, name) is not None]
+        return "ProcessLimits(%s)" % ", ".join("%s=%s" % item for item in items)
+
+
+class ProcessStatus:
+    """How a test / build process ended: return code (negative for a signal), timeout, and any limit violated"""
+    def __init__(self, returncode, timed_out=False, violation=None, truncated=False):
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.violation = violation
+        self.truncated = truncated
+
+
+    # Determines the status of a finished process from its return code, (error) output, and CPU time (if known). A
+    # process whose output was truncated (and which was killed for it) violated the "output" limit. A SIGKILL is only
+    # blamed on the CPU limit if the process used that much CPU time (timeouts, output limits, and the OOM killer also
+    # send SIGKILL).
+    @classmethod
+    def from_process(cls, returncode, timed_out, limits, output, truncated=False, cpu_seconds=None):
+        violation = None
+        if truncated:
+            violation = "output"
+            record_metric("limit_violations")
+        elif limits and returncode:
+            names = dict(limits.items())
+            signaled = _LIMIT_SIGNALS.get(-returncode)
+            if signaled in names:
+                violation = signaled
+            elif returncode == -signal.SIGKILL and not timed_out and "cpu_time" in names and cpu_seconds is not None \
+                    and cpu_seconds >= names["cpu_time"]:
+                violation = "cpu_time"
+            else:
+                for name in names:
+                    pattern = _RESOURCE_LIMITS[name][1]
+                    if pattern and output and pattern.search(output):
+                        violation = name
+                        break
+            if violation:
+                record_metric("limit_violations")
+        return cls(returncode, timed_out, violation, truncated)
+
+
+    @property
+    def signal(self):
+        return -self.returncode if self.returncode and self.returncode < 0 else None
+
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.violation
+
+
+    def __repr__(self):
+        return "ProcessStatus(returncode=%s, timed_out=%s, violation=%s, truncated=%s)" % (self.returncode, self.timed_out,
+                                                                                         self.violation, self.truncated)
+
+
+class ProcessLimitError(subprocess.CalledProcessError):
+    """A command failed (e.g., a build step) because it exceeded a resource limit"""
+    def __init__(self, error, status):
+        super().__init__(error.returncode, error.cmd, error.output, error.stderr)
+        self.status = status
+
+
+    def __str__(self):
+        return "Command '%s' exceeded its %s limit (return code %s)." % (self.cmd, self.status.violation, self.returncode)
+
+
+# Sets the default limits for test processes started (by get_cmd_output, get_vt_output, etc.) from this process.
+def set_process_limits(limits):
+    global _process_limits
+    _process_limits = limits
+
+
+def get_process_limits():
+    return _process_limits
+
+
+# Kills a process and everything it started (test processes each lead their own process group).
+def _kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+# Returns a command to run under the limits (if any).
+def _limited_command(command, limits):
+    return limits.wrap(command) if limits else command
+
+
+# Waits (up to timeout seconds; indefinitely if None) for a child process to exit, without reaping it - so that its CPU
+# time can still be read. Returns whether it has exited.
+def _wait_exited(pid, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        try:
+            if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT | (os.WNOHANG if deadline is not None else 0)):
+                return True
+        except ChildProcessError:
+            return True # Already reaped.
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+
+# Returns the CPU time (in seconds) used by an exited, but not yet reaped, child process - or None if unavailable.
+def _cpu_seconds(pid):
+    try:
+        with open("/proc/%d/stat" % pid, "r") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+# Runs a command to completion (e.g., a build step) under resource limits, in its own process group, returning its
+# output. Raises CalledProcessError if it fails (ProcessLimitError, with its status, if it exceeded a limit).
+def run_limited(command, limits=None, **keywords):
+    process = Popen(_limited_command(command, limits), stdout=PIPE, stderr=subprocess.STDOUT, text=True,
+                    start_new_session=True, **keywords)
+    try:
+        output = process.stdout.read()
+        _wait_exited(process.pid)
+        cpu_seconds = _cpu_seconds(process.pid)
+    except BaseException:
+        _kill_process_group(process.pid)
+        raise
+    finally:
+        process.stdout.close()
+        process.wait()
+
+    if process.returncode:
+        error = subprocess.CalledProcessError(process.returncode, command, output)
+        status = ProcessStatus.from_process(process.returncode, False, limits, output, cpu_seconds=cpu_seconds)
+        if status.violation:
+            raise ProcessLimitError(error, status)
+        raise error
+    return output
+
+
+##### JOBSERVER #####
+# How long a build waiting for a job slot sleeps before checking again (seconds).
+JOBSERVER_POLL_INTERVAL = 0.5
+
+
+class Jobserver:
+    """GNU make-compatible jobserver: a FIFO holding one token per job slot, shared by all concurrent builds"""
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self._directory = tempfile.mkdtemp(prefix="herp-jobserver-")
+        self.path = path.join(self._directory, "tokens")
+        os.mkfifo(self.path, 0o600)
+
+        # Process ids of the builds holding a slot (one line per slot), kept next to the FIFO and updated under a lock
+        # on it by every connection.
+        open(path.join(self._directory, "holders"), "w").close()
+
+        # The FIFO only holds its tokens while it is open somewhere, so keep it open for the jobserver's lifetime.
+        self._keeper = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        os.write(self._keeper, b"+" * tokens)
+
+
+    # Pickled copies (e.g., handed to pool workers) only need the FIFO path; they connect to it from their process.
+    def __getstate__(self):
+        return dict(self.__dict__, _keeper=None)
+
+
+    def connect(self):
+        return JobserverConnection(self.path, self.tokens)
+
+
+    def close(self):
+        if self._keeper is not None:
+            os.close(self._keeper)
+            self._keeper = None
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+
+# Returns whether a process (e.g., a build worker) is still running.
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobserverConnection:
+    """A process's connection to a jobserver; its descriptors are passed to build commands (make joins via MAKEFLAGS)"""
+    def __init__(self, fifo_path, tokens):
+        self.tokens = tokens
+        self.read_fd = os.open(fifo_path, os.O_RDWR)
+        self.write_fd = os.open(fifo_path, os.O_RDWR)
+
+        # Slots are taken without blocking, through a separate open file (make's descriptors must stay blocking).
+        self._slot_fd = os.open(fifo_path, os.O_RDWR | os.O_NONBLOCK)
+        self._holders_path = path.join(path.dirname(fifo_path), "holders")
+
+
+    @property
+    def auth(self):
+        return "--jobserver-auth=%d,%d" % (self.read_fd, self.write_fd)
+
+
+    @property
+    def fds(self):
+        return (self.read_fd, self.write_fd)
+
+
+    # Returns the environment (by default, this process's) with the jobserver added to MAKEFLAGS.
+    def environment(self, env=None):
+        env = dict(os.environ if env is None else env)
+        env["MAKEFLAGS"] = ("%s -j %s" % (env.get("MAKEFLAGS", ""), self.auth)).strip()
+        return env
+
+
+    # Holds a token while a command runs. This is the command's implicit job slot (which make doesn't take from the
+    # FIFO), so that the total number of jobs across all builds never exceeds the token count.
+    @contextlib.contextmanager
+    def slot(self):
+        while (token := self._update_holders(1)) is None:
+            select.select([self._slot_fd], [], [], JOBSERVER_POLL_INTERVAL)
+        try:
+            yield token
+        finally:
+            self._update_holders(-1, token)
+
+
+    # Takes a token (returning it, or None if there is none) and records this process as a holder, or returns the token
+    # and removes the record. Tokens that a make held when it was killed are never returned; but while no build holds a
+    # slot, every token should be in the FIFO, so any missing then are put back. Holders are recorded by process id, so
+    # a worker killed while holding a slot stops counting once it's gone. (If the build it started outlives it, that
+    # build's jobs briefly go beyond the token count.)
+    def _update_holders(self, change, token=None):
+        with open(self._holders_path, "r+") as holders_file:
+            fcntl.flock(holders_file, fcntl.LOCK_EX)
+            holders = [int(line) for line in holders_file.read().split()]
+            holders = [pid for pid in holders if _process_exists(pid)]
+            if not holders:
+                self._reclaim_tokens()
+
+            if change > 0:
+                try:
+                    token = os.read(self._slot_fd, 1)
+                except BlockingIOError:
+                    token = None
+                if token:
+                    holders.append(os.getpid())
+            else:
+                os.write(self.write_fd, token)
+                holders.remove(os.getpid())
+                if not holders:
+                    self._reclaim_tokens()
+
+            holders_file.seek(0)
+            holders_file.truncate()
+            holders_file.write("".join("%d\n" % pid for pid in holders))
+        return token
+
+
+    def _reclaim_tokens(self):
+        available = array.array('i', [0])
+        fcntl.ioctl(self._slot_fd, termios.FIONREAD, available)
+        if available[0] < self.tokens:
+            logging.debug("Reclaiming %d leaked jobserver token(s)." % (self.tokens - available[0]))
+            os.write(self.write_fd, b"+" * (self.tokens - available[0]))
+
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+        os.close(self._slot_fd)
+
+
+##### OUTPUT CAPTURE #####
+# Defaults for capturing a process's output (per stream): a hard limit, beyond which the process is killed and its
+# output truncated, and the amount kept in memory before the rest is spilled to a temporary file.
+DEFAULT_OUTPUT_LIMIT = 64 * 1024 * 1024
+DEFAULT_CAPTURE_MEMORY = 1024 * 1024
+
+
+class OutputCapture:
+    """Output of a process, collected as chunks in memory up to a size, then spilled to disk, up to a hard limit"""
+    def __init__(self, limit=DEFAULT_OUTPUT_LIMIT, memory_limit=DEFAULT_CAPTURE_MEMORY):
+        self.limit = limit
+        self.memory_limit = memory_limit
+        self.size = 0
+        self.truncated = False
+        self._chunks = []
+        self._spill = None
+
+
+    @property
+    def spilled(self):
+        return self._spill is not None
+
+
+    # Adds output, returning False once the hard limit has been reached (anything beyond it is dropped).
+    def write(self, data):
+        if self.truncated:
+            return False
+        if self.limit is not None and self.size + len(data) > self.limit:
+            data = data[:self.limit - self.size]
+            self.truncated = True
+
+        if data:
+            if self._spill is None and self.size + len(data) > self.memory_limit:
+                self._spill = tempfile.TemporaryFile(prefix="herp-output-")
+                self._spill.writelines(self._chunks)
+                self._chunks = []
+            if self._spill is not None:
+                self._spill.write(data)
+            else:
+                self._chunks.append(bytes(data))
+            self.size += len(data)
+
+        return not self.truncated
+
+
+    # Reads a file descriptor to the end into the capture; on_limit is called (once) when the hard limit is reached,
+    # after which output is read and discarded so the writer never blocks on a full pipe. If stop_fd is given, reading
+    # also stops as soon as it becomes readable (e.g., when the other end of a pipe is closed).
+    def drain(self, fd, on_limit=None, stop_fd=None):
+        while True:
+            if stop_fd is not None and stop_fd in select.select([fd, stop_fd], [], [])[0]:
+                break
+            data = os.read(fd, DEFAULT_MAX_READ)
+            if not data:
+                break
+            if not self.write(data) and on_limit:
+                on_limit()
+                on_limit = None
+
+
+    def getvalue(self):
+        if self._spill is None:
+            return b''.join(self._chunks)
+        self._spill.seek(0)
+        data = self._spill.read()
+        self._spill.seek(0, os.SEEK_END)
+        return data
+
+
+    # Returns the output decoded as text (undecodable bytes, e.g. a character cut off by truncation, are replaced).
+    # With universal_newlines, line endings are normalized to "\n" (as with a text-mode pipe).
+    def text(self, universal_newlines=False):
+        text = self.getvalue().decode(errors="replace")
+        return text.replace("\r\n", "\n").replace("\r", "\n") if universal_newlines else text
+
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._chunks = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Returns a capture buffer for one output stream under the given limits (or the defaults).
+def _make_capture(limits):
+    return limits.capture() if limits else OutputCapture()
+
+
+##### PROCESS LOGS #####
+# Lists collecting the test processes run, by thread (see set_process_log); none when not collecting.
+_process_logs = {}
+
+
+# Sets a list to which get_cmd_output, get_py_output, and get_vt_output in this thread append (seconds, ProcessStatus,
+# sleep) for each process they run (not for memoized or replayed output); None stops collecting. herp uses this to
+# time each process when calibrating timeouts.
+def set_process_log(entries):
+    if entries is None:
+        _process_logs.pop(threading.get_ident(), None)
+    else:
+        _process_logs[threading.get_ident()] = entries
+
+
+def get_process_log():
+    return _process_logs.get(threading.get_ident())
+
+
+# Runs a process (through a _run_* function) and logs how long it took, if a process log is installed.
+def _run_logged(runner, sleep, *args):
+    start_time = time.monotonic()
+    results, process_status = runner(*args)
+    entries = get_process_log()
+    if entries is not None:
+        entries.append((time.monotonic() - start_time, process_status, sleep))
+    return results, process_status
+
+
+##### OUTPUT MEMOIZATION #####
+# Memos of command output for the subject being tested, by thread (see set_output_memo); none when memoization is off.
+_output_memos = {}
+
+
+class OutputMemo:
+    """Raw output (and status) of commands already run for a subject, keyed by the working directory, command, input,
+    environment, and run options (e.g., timeout and terminal dimensions)"""
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    @staticmethod
+    def key(mode, working_dir, command, proc_input, env, options):
+        return repr((mode, path.abspath(working_dir), [str(entry) for entry in command], proc_input,
+                     sorted((env or {}).items()), options))
+
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+
+    def put(self, key, entry):
+        self._entries[key] = entry
+
+
+    def clear(self):
+        self._entries = {}
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __bool__(self):
+        return True
+
+
+# Sets the memo consulted (and filled) by get_cmd_output, get_py_output, and get_vt_output in this thread, or turns
+# memoization off (None). herp installs a new memo for each subject when cfg.memoize_output is set.
+def set_output_memo(memo):
+    if memo is None:
+        _output_memos.pop(threading.get_ident(), None)
+    else:
+        _output_memos[threading.get_ident()] = memo
+
+
+def get_output_memo():
+    return _output_memos.get(threading.get_ident())
+
+
+##### TRANSCRIPTS #####
+# Transcripts of the subject being tested (recorded or replayed), by thread (see set_transcript).
+_transcripts = {}
+
+
+class TranscriptError(Exception):
+    pass
+
+
+class TranscriptStore:
+    """Store of test process transcripts for record / replay: each run's input and raw output are kept compressed and
+    content-addressed (so identical output is stored once), indexed per subject by test and call"""
+    def __init__(self, store_path):
+        self.store_path = path.abspath(store_path)
+        os.makedirs(path.join(self.store_path, "objects"), exist_ok=True)
+        os.makedirs(path.join(self.store_path, "subjects"), exist_ok=True)
+
+
+    def _blob_path(self, digest):
+        return path.join(self.store_path, "objects", digest[:2], digest + ".json.gz")
+
+
+    # Stores a transcript entry (unless an identical one exists), returning its content hash.
+    def put(self, entry):
+        data = json.dumps(entry, sort_keys=True).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not path.exists(blob_path):
+            os.makedirs(path.dirname(blob_path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=path.dirname(blob_path), delete=False) as tmp_file:
+                tmp_file.write(gzip.compress(data))
+            os.replace(tmp_file.name, blob_path)
+        return digest
+
+
+    def get(self, digest):
+        with open(self._blob_path(digest), 'rb') as blob:
+            return json.loads(gzip.decompress(blob.read()))
+
+
+    # Returns the transcript of a subject (by name), for recording or (if it was recorded) replaying. Paths under the
+    # roots (e.g., the build destination) are recorded relative to them, so replays don't depend on where they are.
+    def subject(self, name, roots=(), replay=False):
+        return SubjectTranscript(self, name, roots, replay)
+
+
+    def _index_path(self, name):
+        return path.join(self.store_path, "subjects", name + ".json")
+
+
+class SubjectTranscript:
+    """Transcripts of one subject's test processes, grouped by test label (see set_transcript_label)"""
+    def __init__(self, store, name, roots, replay):
+        self.store = store
+        self.name = name
+        self.replaying = replay
+        self.label = "setup"
+        self.tests = {}
+        self.setup_exceptions = []
+        self._roots = sorted(((path.abspath(root), "$root%d" % index) for index, root in enumerate(roots) if root),
+                             key=lambda entry: -len(entry[0]))
+        self._served = {}
+        self.missing = None     # Why there's nothing to replay, if the subject wasn't (successfully) recorded
+
+        if replay:
+            try:
+                with open(store._index_path(name), 'r') as index_file:
+                    index = json.load(index_file)
+                self.tests, self.setup_exceptions = index["tests"], index["setup_exceptions"]
+            except (OSError, ValueError, KeyError) as e:
+                self.missing = "No recorded transcript for %s (%s: %s)." % (name, type(e).__name__, e)
+
+
+    def _relative(self, text):
+        for root, placeholder in self._roots:
+            text = text.replace(root, placeholder)
+        return text
+
+
+    # Calls are keyed by what determines their output, save for the environment and timeout (so that rescoring with
+    # different timeouts still replays).
+    def _key(self, mode, working_dir, command, proc_input, options):
+        return repr((mode, self._relative(path.abspath(working_dir)), [self._relative(str(entry)) for entry in command],
+                     proc_input, options))
+
+
+    def record(self, mode, working_dir, command, proc_input, options, results, status):
+        entry = {"input": proc_input, "output": results,
+                 "status": [status.returncode, status.timed_out, status.violation, status.truncated] if status else None}
+        calls = self.tests.setdefault(self.label, {})
+        calls.setdefault(self._key(mode, working_dir, command, proc_input, options), []).append(self.store.put(entry))
+
+
+    # Returns the labels to look for a call in when it wasn't recorded under the current one: those of the same test
+    # (including batches it was part of), then all others. (E.g., after a rubric change, a penalty may run for a test
+    # that scored 0 when it was recorded; its calls usually repeat the test's own.)
+    def _fallback_labels(self, label):
+        parts = label.split("/")
+        if len(parts) >= 2:
+            related = [other for other in self.tests if other.split("/")[0] == parts[0] and len(other.split("/")) > 1
+                       and parts[1] in other.split("/")[1].split(",")]
+        else:
+            related = []
+        return related + [other for other in self.tests if other not in related]
+
+
+    # Returns the recorded (output, ProcessStatus) of a call; repeated calls are served in recorded order. A call not
+    # recorded under the current label is served from an identical call under another (see _fallback_labels).
+    def replay(self, mode, working_dir, command, proc_input, options):
+        key = self._key(mode, working_dir, command, proc_input, options)
+        digests = self.tests.get(self.label, {}).get(key)
+        if not digests:
+            digests = next((self.tests[label][key] for label in self._fallback_labels(self.label)
+                            if key in self.tests[label]), None)
+        if not digests:
+            raise TranscriptError(self.missing or "No recorded run of %s (input %r) for %s in %s." %
+                                  (command, proc_input, self.label, self.name))
+        served = self._served.get((self.label, key), 0)
+        self._served[(self.label, key)] = served + 1
+        entry = self.store.get(digests[min(served, len(digests) - 1)])
+        return entry["output"], ProcessStatus(*entry["status"]) if entry["status"] else None
+
+
+    def save(self):
+        index_path = self.store._index_path(self.name)
+        with tempfile.NamedTemporaryFile(mode='w', dir=path.dirname(index_path), delete=False) as tmp_file:
+            json.dump({"tests": self.tests, "setup_exceptions": self.setup_exceptions}, tmp_file)
+        os.replace(tmp_file.name, index_path)
+
+
+# Sets the transcript recorded (or replayed, instead of running processes) by get_cmd_output, get_py_output, and
+# get_vt_output in this thread; None turns recording / replay off. herp sets one for each subject with --record / --replay.
+def set_transcript(transcript):
+    if transcript is None:
+        _transcripts.pop(threading.get_ident(), None)
+    else:
+        _transcripts[threading.get_ident()] = transcript
+
+
+def get_transcript():
+    return _transcripts.get(threading.get_ident())
+
+
+# Labels the calls that follow (e.g., with the test being run), if there is a transcript.
+def set_transcript_label(label):
+    transcript = get_transcript()
+    if transcript:
+        transcript.label = label
+
+
+def ansi_to_text(text, lines=30, columns=80, avoid_collisions=False):
 #, convert_glyphs=True):
-    screen = pyte.Screen(columns, lines)
+    screen = _LineDrawingScreen(columns, lines, avoid_collisions)
     stream = pyte.Stream(screen)
     stream.use_utf8 = False
     stream.feed(text)
@@ -611,9 +1711,47 @@ def get_vt_output(working_dir, command, proc_input, timeout, **keywords):
     keep_lines = keywords.pop("keep_lines", False)
     sleep = keywords.pop("sleep", False)
     raw = keywords.pop("raw", False)
+    env = keywords.pop("env", None)
+    avoid_collisions = keywords.pop("avoid_collisions", False)
+    limits = keywords.pop("limits", None)
+    limits = limits if limits is not None else _process_limits
+    report_status = keywords.pop("status", False)
 
-    # Process the input on the front end.
+    # Process the input on the front end, then run the command (unless its output is already memoized).
     proc_input = _prep_input(proc_input)
+    memo = get_output_memo()
+    memo_key = memo.key("vt", working_dir, command, proc_input, env, (timeout, sleep, lines, columns)) if memo else None
+    cached = memo.get(memo_key) if memo_key else None
+    transcript = get_transcript()
+
+    if transcript and transcript.replaying:
+        results, process_status = transcript.replay("vt", working_dir, command, proc_input, (lines, columns))
+    elif cached:
+        results, process_status = cached
+    else:
+        results, process_status = _run_logged(_run_vt, sleep, working_dir, command, proc_input, timeout, lines, columns,
+                                              sleep, env, limits)
+        if memo_key:
+            memo.put(memo_key, (results, process_status))
+
+    if transcript and not transcript.replaying:
+        transcript.record("vt", working_dir, command, proc_input, (lines, columns), results, process_status)
+
+    if not raw:
+        results = ansi_to_text(results, lines, columns, avoid_collisions)
+
+    if not raw and tokenize:
+    
+        results = parse_tokens(results)
+        if not keep_lines:
+            results = list(itertools.chain(*results))
+
+    return (results, process_status) if report_status else results
+
+
+# Runs a command in a virtual terminal, returning its raw output (with escape sequences) and a ProcessStatus.
+def _run_vt(working_dir, command, proc_input, timeout, lines, columns, sleep, env, limits):
+    process_status = None
 
     # Ugly hack to make sure the window size is big enough (ugh).
     old_rows = os.environ['LINES'] if 'LINES' in os.environ else None
@@ -627,7 +1765,9 @@ def get_vt_output(working_dir, command, proc_input, timeout, **keywords):
 
     try:
         # Start the process, get the output, and return to the original directory.
-        process = pexpect.spawn(command[0], command[1:], timeout=timeout)
+        # (The pty makes the process a session / process group leader, so its whole tree can be killed when done.)
+        limited_command = _limited_command(command, limits)
+        process = pexpect.spawn(limited_command[0], limited_command[1:], timeout=timeout, env=env)
 
         for pre_delay, entry, post_delay in proc_input:
             time.sleep(pre_delay)
@@ -638,26 +1778,37 @@ def get_vt_output(working_dir, command, proc_input, timeout, **keywords):
         if sleep:
             time.sleep(timeout)
 
-        # Read data from the standard output (looping until there's nothing left).
-        results = b''
-
-        while True:
-            # Read from the file without blocking - just get what's available on each call.
-            try:
-                results += process.read_nonblocking(timeout=timeout)
-            # If the process terminated due to a timeout, log an info message in case it was unexpected.
-            except pexpect.TIMEOUT as e:
-#                logging.info("Timeout when running %s with input %s." % (command, proc_input)) TODO: make not print...
-                break
-            # If we reached the end of the file,
-            except pexpect.EOF:
-                break
-
-        results = results.decode()
+        # Read data from the standard output (looping until there's nothing left, or the output limit is reached).
+        timed_out = False
+
+        with _make_capture(limits) as capture:
+            while True:
+                # Read from the file without blocking - just get what's available on each call.
+                try:
+                    if not capture.write(process.read_nonblocking(DEFAULT_MAX_READ, timeout=timeout)):
+                        break
+                # If the process terminated due to a timeout, log an info message in case it was unexpected. (Programs
+                # waiting for input normally end this way, so this isn't counted in the test_timeouts metric.)
+                except pexpect.TIMEOUT as e:
+#                    logging.info("Timeout when running %s with input %s." % (command, proc_input)) TODO: make not print...
+                    timed_out = True
+                    break
+                # If we reached the end of the file,
+                except pexpect.EOF:
+                    break
+
+            results = capture.text()
+            truncated = capture.truncated
+
+        if not _wait_exited(process.pid, 0):
+            _kill_process_group(process.pid)
+        _wait_exited(process.pid)
+        cpu_seconds = _cpu_seconds(process.pid)
         process.terminate(True)
+        process.close()
 
-        if not raw:
-            results = ansi_to_text(results, lines, columns)
+        returncode = -process.signalstatus if process.signalstatus else process.exitstatus
+        process_status = ProcessStatus.from_process(returncode, timed_out, limits, results, truncated, cpu_seconds)
 
     except Exception as e:
         stack_trace = traceback.format_exc()
@@ -677,47 +1828,121 @@ def get_vt_output(working_dir, command, proc_input, timeout, **keywords):
         else:
             del os.environ['COLUMNS']
 
-    if not raw and tokenize:
-    
-        results = parse_tokens(results)
-        if not keep_lines:
-            results = list(itertools.chain(*results))
-
-    return results
+    return results, process_status
 
 
 ##### CONSOLE OUTPUT COMMAND PROCESSING #####
-def get_py_output(working_dir, command, py_input, timeout, tokenize=True, keep_lines=False, sleep=False, raw=False):
+def get_py_output(working_dir, command, py_input, timeout, tokenize=True, keep_lines=False, sleep=False, raw=False, env=None,
+                  limits=None, status=False):
     command = [command] if isinstance(command, str) else command if hasattr(command, '__iter__') else [str(command)]
-    return get_cmd_output(working_dir, [sys.executable] + command, py_input, timeout, tokenize, keep_lines, sleep, raw)
+    return get_cmd_output(working_dir, [sys.executable] + command, py_input, timeout, tokenize, keep_lines, sleep, raw, env,
+                          limits, status)
 
 
-def get_cmd_output(working_dir, command, proc_input, timeout, tokenize=True, keep_lines=False, sleep=False, raw=False):
-    # Format the input, grab the current working directory, then change to the target directory.
+# Runs a command (with resource limits - by default, those from set_process_limits) and returns its output. With
+# status=True, returns an (output, ProcessStatus) tuple instead. Output is read as it is produced (so the process never
+# blocks on a full pipe) into bounded capture buffers; past the output limit, the process is killed and its output
+# truncated.
+def get_cmd_output(working_dir, command, proc_input, timeout, tokenize=True, keep_lines=False, sleep=False, raw=False, env=None,
+                   limits=None, status=False):
+    # Format the input, then run the command (unless its output is already memoized).
     proc_input = _prep_input(proc_input)
+    limits = limits if limits is not None else _process_limits
+    memo = get_output_memo()
+    memo_key = memo.key("cmd", working_dir, command, proc_input, env, (timeout,)) if memo else None
+    cached = memo.get(memo_key) if memo_key else None
+    transcript = get_transcript()
+
+    if transcript and transcript.replaying:
+        results, process_status = transcript.replay("cmd", working_dir, command, proc_input, ())
+    elif cached:
+        results, process_status = cached
+    else:
+        results, process_status = _run_logged(_run_cmd, False, working_dir, command, proc_input, timeout, env, limits)
+        if memo_key:
+            memo.put(memo_key, (results, process_status))
+
+    if transcript and not transcript.replaying:
+        transcript.record("cmd", working_dir, command, proc_input, (), results, process_status)
+
+    # Format the return data, as appropriate.
+    if tokenize:
+        results = parse_tokens(results)
+        if not keep_lines:
+            results = list(itertools.chain(*results))
+
+    return (results, process_status) if status else results
+
+
+# Runs a command, returning its output (as text) and a ProcessStatus.
+def _run_cmd(working_dir, command, proc_input, timeout, env, limits):
+    # Grab the current working directory, then change to the target directory.
+    process_status = None
     start_dir = os.getcwd()
     os.chdir(working_dir)
 
     # Start the process, send input, and gather output.
     try:
-        # First, start the process; then, after the designated delay, send the data.
-        process = Popen(command, stdout=PIPE, stdin=PIPE, stderr=PIPE, text=True)
+        # First, start the process (in its own process group) and its output readers; then, after the designated delay,
+        # send the data.
+        process = Popen(_limited_command(command, limits), stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env,
+                        start_new_session=True)
+
+        # (Closing the stop pipe's write end tells the readers to stop, if the output pipes don't reach end of file.)
+        output, error_output = _make_capture(limits), _make_capture(limits)
+        stop_read, stop_write = os.pipe()
+        readers = [threading.Thread(target=capture.drain, args=(stream.fileno(), lambda: _kill_process_group(process.pid),
+                                                                stop_read), daemon=True)
+                   for capture, stream in ((output, process.stdout), (error_output, process.stderr))]
+        for reader in readers:
+            reader.start()
 
         for pre_delay, entry, post_delay in proc_input:
             time.sleep(pre_delay)
-            process.stdin.write(entry + "\n")
-            process.stdin.flush()
+            try:
+                process.stdin.write((entry + "\n").encode())
+                process.stdin.flush()
+            except BrokenPipeError:
+                break # The process has already exited (e.g., killed for exceeding a limit); collect what it left.
             time.sleep(post_delay)
 
-        # After all input has been sent, if the process has not quit, wait - and kill if necessary.
-        if process.poll() == None:
-            try:
-                process.wait(timeout=timeout)
-            except TimeoutExpired as e:
-                process.kill()
+        # After all input has been sent, if the process has not quit, wait - and kill it (and its children) if necessary.
+        timed_out = False
+        if not _wait_exited(process.pid, timeout):
+            timed_out = True
+            _kill_process_group(process.pid)
 
-        # Gather the output of the process.
-        results = process.communicate(timeout=timeout)[0]
+        # Gather the output of the process once everything holding its pipes is gone - or, if something escaped its
+        # process group and still holds them, after one more timeout (shared by both readers). Then the readers are
+        # stopped (before the captures and pipes are closed under them), and if that cut them off, the output is marked
+        # truncated (though no limit was exceeded).
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        _wait_exited(process.pid)
+        cpu_seconds = _cpu_seconds(process.pid)
+        process.wait()
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for reader in readers:
+            reader.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+        abandoned = any(reader.is_alive() for reader in readers)
+        os.close(stop_write)
+        for reader in readers:
+            reader.join()
+        os.close(stop_read)
+
+        with output, error_output:
+            results, errors = output.text(universal_newlines=True), error_output.text(universal_newlines=True)
+            truncated = output.truncated or error_output.truncated
+        process.stdout.close()
+        process.stderr.close()
+
+        process_status = ProcessStatus.from_process(process.returncode, timed_out, limits, errors, truncated, cpu_seconds)
+        process_status.truncated = truncated or abandoned
+        if timed_out:
+            record_metric("test_timeouts")
     except Exception as e:
         print(e)
 
@@ -725,36 +1950,304 @@ def get_cmd_output(working_dir, command, proc_input, timeout, tokenize=True, kee
     finally:
         os.chdir(start_dir)
 
-    # Format the return data, as appropriate.
-    if tokenize:
-        results = parse_tokens(results)
-        if not keep_lines:
-            results = list(itertools.chain(*results))
+    return results, process_status
+
+
+##### REFERENCE OUTPUT STORE #####
+_file_digests = {}
+
+
+# Returns a content hash of a file, cached by its path, size, and modification time.
+def _file_digest(filename):
+    stats = os.stat(filename)
+    key = (filename, stats.st_size, stats.st_mtime_ns)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as target:
+            for block in iter(lambda: target.read(DEFAULT_MAX_READ), b''):
+                digest.update(block)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+class ReferenceStore:
+    """Persistent store of reference solution output, keyed by a hash of the command, input, and environment"""
+    # A read-only store (e.g., a worker's) still adds the entries it computes, but doesn't create or clear the store.
+    def __init__(self, store_path, read_only=False):
+        self.store_path = path.abspath(store_path)
+        self.read_only = read_only
+        self._entries = {}
+
+        if not read_only:
+            os.makedirs(self.store_path, exist_ok=True)
+
+
+    # Returns a read-only view of this store (e.g., to hand to test workers via the framework context).
+    def as_read_only(self):
+        return ReferenceStore(self.store_path, read_only=True)
+
+
+    # Same signature as toolbox.get_cmd_output; sleep and raw are passed through to it, and limits are part of the key
+    # (they can truncate the output).
+    def get_cmd_output(self, working_dir, command, proc_input, timeout, tokenize=True, keep_lines=False, sleep=False,
+                       raw=False, env=None, limits=None, status=False):
+        runner = lambda: get_cmd_output(working_dir, command, proc_input, timeout, False, False, sleep, raw, env, limits,
+                                        status=True)
+        options = {"limits": sorted(vars(limits).items()) if limits else None}
+        output, process_status = self._get_output("cmd", runner, working_dir, command, proc_input, env, tokenize,
+                                                  keep_lines, options)
+        return (output, process_status) if status else output
+
+
+    def get_py_output(self, working_dir, command, py_input, timeout, tokenize=True, keep_lines=False, sleep=False,
+                      raw=False, env=None, limits=None, status=False):
+        command = [command] if isinstance(command, str) else command if hasattr(command, '__iter__') else [str(command)]
+        return self.get_cmd_output(working_dir, [sys.executable] + command, py_input, timeout, tokenize, keep_lines, sleep,
+                                   raw, env, limits, status)
+
+
+    def get_vt_output(self, working_dir, command, proc_input, timeout, **keywords):
+        tokenize = keywords.pop("tokenize", True)
+        keep_lines = keywords.pop("keep_lines", False)
+        dependencies = keywords.pop("dependencies", ())
+        env = keywords.get("env", None)
+        vt_keywords = dict(keywords, lines=keywords.get("lines", 30), columns=keywords.get("columns", 80))
+
+        status = vt_keywords.pop("status", False)
+        runner = lambda: get_vt_output(working_dir, command, proc_input, timeout, tokenize=False, status=True, **vt_keywords)
+        options = {key: value for key, value in vt_keywords.items() if key != "env"}
+        output, process_status = self._get_output("vt", runner, working_dir, command, proc_input, env,
+                                                  tokenize and not keywords.get("raw"), keep_lines,
+                                                  dict(options, dependencies=dependencies))
+        return (output, process_status) if status else output
+
+
+    # Removes all stored entries.
+    def clear(self):
+        self._entries = {}
+        if not self.read_only and path.isdir(self.store_path):
+            shutil.rmtree(self.store_path)
+            os.makedirs(self.store_path)
+
+
+    # Returns the (formatted) output and the ProcessStatus of the reference run.
+    def _get_output(self, mode, runner, working_dir, command, proc_input, env, tokenize, keep_lines, options):
+        key = self._make_key(mode, working_dir, command, proc_input, env, options)
+        entry = self._entries.get(key) or self._load(key)
+
+        # If this is a new reference run, execute it once and persist the output (workers included - saves are atomic, so
+        # concurrent workers computing the same entry just replace each other's identical copies). Runs that failed to
+        # start, timed out, or exceeded a limit aren't kept, so they are retried next time.
+        if entry is None:
+            raw, status = runner()
+            entry = {"raw": raw, "tokens": parse_tokens(raw) if isinstance(raw, str) else None}
+            if status is None or status.timed_out or status.violation:
+                logging.warning("Reference run of %s did not complete (%s); its output was not stored." % (command, status))
+                return self._format(entry, tokenize, keep_lines), status
+            entry["status"] = [status.returncode, status.truncated]
+            self._save(key, entry)
+
+        self._entries[key] = entry
+        return self._format(entry, tokenize, keep_lines), self._status(entry)
+
+
+    # Stored entries are from runs that completed, so only the return code and truncation are kept.
+    @staticmethod
+    def _status(entry):
+        returncode, truncated = entry.get("status", (None, False))
+        return ProcessStatus(returncode, truncated=truncated)
+
+
+    @staticmethod
+    def _format(entry, tokenize, keep_lines):
+        if not tokenize or entry["tokens"] is None:
+            return entry["raw"]
+        return entry["tokens"] if keep_lines else list(itertools.chain(*entry["tokens"]))
+
+
+    # Builds the key from the command, input, and environment, plus content hashes of any files the command refers to
+    # (the reference binary / script and file arguments) so that rebuilding the reference invalidates its entries.
+    def _make_key(self, mode, working_dir, command, proc_input, env, options):
+        working_dir = path.abspath(working_dir)
+        command = [str(entry) for entry in command]
+        fingerprints = []
+
+        executable = command[0] if os.sep in command[0] else shutil.which(command[0])
+        for entry in ([executable] if executable else []) + command[1:] + list(options.pop("dependencies", ()) or ()):
+            filename = path.join(working_dir, entry)
+            if path.isfile(filename):
+                fingerprints.append((entry, _file_digest(filename)))
+
+        identity = repr((mode, working_dir, command, _prep_input(proc_input), sorted((env or {}).items()),
+                         sorted(options.items()), fingerprints))
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+    def _entry_path(self, key):
+        return path.join(self.store_path, key[:2], key + ".json")
+
+
+    def _load(self, key):
+        try:
+            with open(self._entry_path(key), 'r') as entry_file:
+                return json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+
+    # Writes the entry to a temporary file and renames it so concurrent readers never see a partial entry.
+    def _save(self, key, entry):
+        entry_path = self._entry_path(key)
+        os.makedirs(path.dirname(entry_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode='w', dir=path.dirname(entry_path), delete=False) as tmp_file:
+            json.dump(entry, tmp_file)
+        os.replace(tmp_file.name, entry_path)
+
+
+##### SHARED FRAMEWORK DATA #####
+# Data published by the framework lives in files on a memory-backed filesystem (when there is one), which every worker
+# maps read-only; mappings are cached per process, by file.
+_SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+_shared_mappings = {}
+_published_handles = []
+
+
+class SharedHandle:
+    """Handle to framework data published once (see publish_shared); it pickles as just the data's location, and maps
+    the data (read-only, without copying it) when first used in a process"""
+    def __init__(self, filename, kind, shape=None, dtype=None, owned=True):
+        self.filename = filename
+        self.kind = kind        # "array" (NumPy array), "bytes" (memoryview), "object" (unpickled once per process)
+        self.shape = shape
+        self.dtype = dtype
+        self.owned = owned      # Whether releasing the handle removes the file (not for files shared with share_file)
+
+
+    # Returns the data: a read-only NumPy array or memoryview over the mapping, or (for other objects) the object.
+    def get(self):
+        if self.filename not in _shared_mappings:
+            with open(self.filename, 'rb') as target:
+                mapped = mmap.mmap(target.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(target.fileno()).st_size else b''
+            if self.kind == "array":
+                value = numpy.frombuffer(mapped, dtype=numpy.dtype(self.dtype)).reshape(self.shape)
+            elif self.kind == "bytes":
+                value = memoryview(mapped)
+            else:
+                value = pickle.loads(mapped)
+            _shared_mappings[self.filename] = value
+        return _shared_mappings[self.filename]
+
 
-    return results
+    # Removes the published data (existing mappings stay valid until they're dropped).
+    def release(self):
+        _shared_mappings.pop(self.filename, None)
+        if self.owned:
+            try:
+                os.unlink(self.filename)
+            except FileNotFoundError:
+                pass
+        if self in _published_handles:
+            _published_handles.remove(self)
+
+
+    def __repr__(self):
+        return "SharedHandle(%s, %s)" % (self.filename, self.kind)
+
+
+# Publishes framework data (e.g., from initialize_framework) for workers to map instead of receiving a copy with each
+# submission: NumPy arrays (of plain values) and bytes-like objects are mapped as-is; anything else is pickled and loaded
+# once per worker. Returns a SharedHandle to put in the framework context. Release it (or call release_shared_data) in
+# shutdown_framework; herp also releases anything left when it exits.
+def publish_shared(value):
+    descriptor, filename = tempfile.mkstemp(prefix="herp-shared-", dir=_SHARED_DIR)
+    with os.fdopen(descriptor, 'wb') as target:
+        # (Arrays holding Python objects can't be mapped as raw values, so they're pickled like other objects.)
+        if isinstance(value, numpy.ndarray) and not value.dtype.hasobject:
+            value = numpy.ascontiguousarray(value)
+            target.write(value.data)
+            handle = SharedHandle(filename, "array", value.shape, value.dtype.descr if value.dtype.fields else value.dtype.str)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            target.write(value)
+            handle = SharedHandle(filename, "bytes")
+        else:
+            pickle.dump(value, target, protocol=pickle.HIGHEST_PROTOCOL)
+            handle = SharedHandle(filename, "object")
+
+    _published_handles.append(handle)
+    return handle
+
+
+# Shares an existing file (e.g., a large expected-output file) with workers, which map it read-only as bytes. If shape
+# and dtype are given, the file is mapped as a NumPy array of raw values instead.
+def share_file(filename, shape=None, dtype=None):
+    if dtype is not None:
+        return SharedHandle(path.abspath(filename), "array", shape if shape is not None else -1, numpy.dtype(dtype).str, False)
+    return SharedHandle(path.abspath(filename), "bytes", owned=False)
+
+
+# Releases all data published from this process (herp calls this when grading ends, even if it fails).
+def release_shared_data():
+    for handle in list(_published_handles):
+        handle.release()
 
 
 ##### MATCHING FUNCTIONS #######
-def match_sets(left_set, right_set):
-    matched = [None] * max(len(left_set), len(right_set))
+# Maps the tokens of both sequences to small integers so that hashing and comparison in the matchers are cheap.
+def _intern_tokens(left_set, right_set):
+    table = {}
+    left = [table.setdefault(token, len(table)) for token in left_set]
+    right = [table.setdefault(token, len(table)) for token in right_set]
+    return left, right
+
+
+# Returns the first index at which the (interned) needle occurs contiguously in the haystack, or -1 if it doesn't.
+def _find_run(haystack, needle):
+    if not needle:
+        return 0
+
+    # Search the packed machine-word representations; discard hits that don't fall on a token boundary.
+    packed = array.array('q', haystack).tobytes()
+    target = array.array('q', needle).tobytes()
+    index = packed.find(target)
+    while index != -1 and index % 8:
+        index = packed.find(target, index + 1)
+    return index // 8 if index != -1 else -1
+
+
+# Returns true if the candidate is a (not necessarily contiguous) subsequence of the superset. Stops at first failure.
+def _is_subsequence(candidate, superset):
+    remaining = iter(superset)
+    return all(token in remaining for token in candidate)
 
-    seq = difflib.SequenceMatcher(None, left_set, right_set, False)
-    for a, b, size in seq.get_matching_blocks():
-        for index in range(0, size):
-            matched[a + index] = b + index
+
+def _match_blocks(left, right, size):
+    matched = [None] * size
+
+    seq = difflib.SequenceMatcher(None, left, right, False)
+    for a, b, length in seq.get_matching_blocks():
+        matched[a:a + length] = range(b, b + length)
 
     return matched
 
 
+def match_sets(left_set, right_set):
+    # Identical sets are a single matching block, so the general alignment can be skipped.
+    if len(left_set) == len(right_set) and list(left_set) == list(right_set):
+        return list(range(len(left_set)))
+
+    left, right = _intern_tokens(left_set, right_set)
+    return _match_blocks(left, right, max(len(left), len(right)))
+
+
 def match_subset(superset, candidate):
-    matched = [None] * len(candidate)
+    candidate, superset = _intern_tokens(candidate, superset)
 
-    seq = difflib.SequenceMatcher(None, candidate, superset, False)
-    for a, b, size in seq.get_matching_blocks():
-        for index in range(0, size):
-            matched[a + index] = b + index
+    # If the candidate occurs contiguously, its first occurrence is the (single) longest matching block.
+    start = _find_run(superset, candidate)
+    if start != -1:
+        return list(range(start, start + len(candidate)))
 
-    return matched
+    return _match_blocks(candidate, superset, len(candidate))
 
 
 ##### RESULT COMPARATORS #####
@@ -774,6 +2267,17 @@ def compare_iterable_subset(lhs, rhs):
 
 
 def compare_iterable_custom(match_function, lhs, rhs):
+    # Shortcuts for the built-in matchers: a full exact match means the sets are equal, and a full subset match
+    # requires the candidate to be a subsequence (and is guaranteed when it occurs contiguously).
+    if match_function is match_sets:
+        return 1 if len(lhs) == len(rhs) and list(lhs) == list(rhs) else 0
+    elif match_function is match_subset:
+        candidate, superset = _intern_tokens(rhs, lhs)
+        if not _is_subsequence(candidate, superset):
+            return 0
+        elif _find_run(superset, candidate) != -1:
+            return 1
+
     # Get match results and do a basic comparison. We'll need 100% match.
     for entry in match_function(lhs, rhs):
         if entry == None:
@@ -782,23 +2286,314 @@ def compare_iterable_custom(match_function, lhs, rhs):
     return 1
 
 
-# Get screen dimensions
-def __get_screen_dimensions(text):
-    return (len(text), len(text[0]) if len(text) > 0 else 0)
+##### FILE COMPARISON #####
+# Files are compared through memory maps, a block (exact) or line segment (normalized) at a time, so memory use doesn't
+# grow with file size; comparison stops at the first mismatch.
+COMPARE_BLOCK_SIZE = 1024 * 1024
+_MISMATCH_EXCERPT = 80
+_WORD_PATTERN = re.compile(r"\S+")
+_SEGMENT_SPACES = (b" ", b"\t", b"\r", b"\x0b", b"\x0c")
 
 
-# Returns true i the position is in the range, and false otherwise.
-def __pos_in_range(pos_x, pos_y, start_x, start_y, width, height):
-    if pos_x >= start_x and pos_x < start_x + width:
-        if pos_y >= start_y and pos_y < start_y + height:
-            return True
-    return False
+class FileMismatch:
+    """Location (1-based line / column in each file) and text of the first difference between two compared files"""
+    def __init__(self, lhs_line, lhs_column, lhs_text, rhs_line, rhs_column, rhs_text):
+        self.lhs_line = lhs_line
+        self.lhs_column = lhs_column
+        self.lhs_text = lhs_text
+        self.rhs_line = rhs_line
+        self.rhs_column = rhs_column
+        self.rhs_text = rhs_text
+
+
+    def __str__(self):
+        return "line %d, column %d: %r != line %d, column %d: %r" % (self.lhs_line, self.lhs_column, self.lhs_text,
+                                                                     self.rhs_line, self.rhs_column, self.rhs_text)
+
+
+    def __repr__(self):
+        return "FileMismatch(%s)" % self
+
+
+# Maps a file read-only (None for an empty file, which can't be mapped).
+@contextlib.contextmanager
+def _map_file(filename):
+    with open(filename, 'rb') as target:
+        if os.fstat(target.fileno()).st_size == 0:
+            yield None
+        else:
+            with mmap.mmap(target.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # Files are read front to back, so pages can be read ahead and dropped soon after.
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                yield mapped
+
+
+def _decode_line(line):
+    return line.decode(errors="replace").rstrip("\r\n")
+
+
+def _excerpt(text, column=1):
+    start = max(0, column - 1 - _MISMATCH_EXCERPT // 4)
+    return text[start:start + _MISMATCH_EXCERPT]
+
+
+# Returns the mismatch at a byte offset in an exact comparison (where both files are identical before it).
+def _exact_mismatch(lhs, rhs, offset, line):
+    positions = []
+    for mapped in (lhs, rhs):
+        line_start = mapped.rfind(b"\n", 0, offset) + 1 if mapped else 0
+        line_end = mapped.find(b"\n", offset) if mapped else -1
+        text = _decode_line(mapped[line_start:line_end if line_end != -1 else len(mapped)]) if mapped else ""
+        column = len(mapped[line_start:offset].decode(errors="replace")) + 1 if mapped else 1
+        positions += [line, column, _excerpt(text, column)]
+    return FileMismatch(*positions)
+
+
+# Returns the byte offset and line number of the first difference between two mapped files, or None if they're equal.
+def _first_difference(lhs, rhs):
+    lhs_size, rhs_size = len(lhs) if lhs else 0, len(rhs) if rhs else 0
+    line = 1
+
+    # Compare block by block (counting lines as we go); within a differing block, find the first differing byte.
+    for start in range(0, min(lhs_size, rhs_size), COMPARE_BLOCK_SIZE):
+        lhs_block, rhs_block = lhs[start:start + COMPARE_BLOCK_SIZE], rhs[start:start + COMPARE_BLOCK_SIZE]
+        if lhs_block != rhs_block:
+            length = min(len(lhs_block), len(rhs_block))
+            differs = numpy.frombuffer(lhs_block, numpy.uint8, length) != numpy.frombuffer(rhs_block, numpy.uint8, length)
+            index = int(numpy.argmax(differs)) if differs.any() else length
+            return start + index, line + lhs_block.count(b"\n", 0, index)
+        line += lhs_block.count(b"\n")
+
+    # If one file is a prefix of the other, they differ where the shorter one ends.
+    return (min(lhs_size, rhs_size), line) if lhs_size != rhs_size else None
+
+
+def _find_exact_mismatch(lhs, rhs):
+    difference = _first_difference(lhs, rhs)
+    return _exact_mismatch(lhs, rhs, *difference) if difference else None
+
+
+# Generates (line number, column, text, text column, item) for each item (word / token) of a mapped file after
+# normalization, from a byte offset (at the start of the given line) on. Line numbers count "\n"-terminated lines; other
+# separators (e.g., "\r") split a line into pieces that share its number. With line_ends, each piece that has items ends
+# with a "\n" item (which no word or token can equal). Lines are read in segments of at most COMPARE_BLOCK_SIZE bytes,
+# cut after whitespace (within a longer word, between characters), so memory use doesn't depend on line length either;
+# the text is the part of a piece within one segment, for excerpts.
+def _normalized_items(mapped, normalize, columns, line_ends, start=0, line_number=0):
+    size = len(mapped) if mapped else 0
+    position = start
+    while position < size:
+        line_end = mapped.find(b"\n", position)
+        line_end = size if line_end == -1 else line_end
+        line_number += 1
+        piece_column, piece_items = 0, False
+
+        while position < line_end:
+            end = min(line_end, position + COMPARE_BLOCK_SIZE)
+            end = _segment_end(mapped, position, end) if end < line_end else end
+            parts = mapped[position:end].decode(errors="replace").splitlines(True)
+            for index, part in enumerate(parts):
+                text = part.splitlines()[0]
+                for item, column in zip(normalize(text), columns(text)):
+                    piece_items = True
+                    yield line_number, piece_column + column, text, column, item
+
+                # A piece ends at a separator or at the end of the line; otherwise it continues in the next segment.
+                if text != part or (end == line_end and index == len(parts) - 1):
+                    if line_ends and piece_items:
+                        yield line_number, piece_column + len(text) + 1, text, len(text) + 1, "\n"
+                    piece_column, piece_items = 0, False
+                else:
+                    piece_column += len(text)
+            position = end
+
+        position = line_end + 1
+
+
+# Returns where to end a segment of a long line (that would otherwise end at end): after its last whitespace, or if
+# there is none, at the last character boundary.
+def _segment_end(mapped, start, end):
+    cut = max(mapped.rfind(space, start, end) for space in _SEGMENT_SPACES) + 1
+    if cut > start:
+        return cut
+    while end > start + 1 and mapped[end] & 0xC0 == 0x80:
+        end -= 1
+    return end
+
+
+def _whitespace_items(piece):
+    return piece.split()
+
+
+def _whitespace_columns(piece):
+    return [match.start() + 1 for match in _WORD_PATTERN.finditer(piece)]
+
+
+# Returns the column of each token parse_tokens would produce for a line (tokens from one word share its column).
+def _token_columns(piece, is_case_sensitive, number_string_match):
+    columns = []
+    for match in _WORD_PATTERN.finditer(piece.translate(_PUNC_TO_SPACE)):
+        for tokens in iter_tokens(match.group(), is_case_sensitive, number_string_match):
+            columns += [match.start() + 1] * len(tokens)
+    return columns
+
+
+def _find_normalized_mismatch(lhs, rhs, normalize, columns, line_ends):
+    # Both files are byte-for-byte identical up to the line where they first differ (so they normalize identically up to
+    # there, too); only normalize from that line on.
+    difference = _first_difference(lhs, rhs)
+    if not difference:
+        return None
+    offset, line = difference
+    start = lhs.rfind(b"\n", 0, offset) + 1 if lhs else 0
+    lhs_items, rhs_items = (_normalized_items(mapped, normalize, columns, line_ends, start, line - 1)
+                            for mapped in (lhs, rhs))
+
+    for lhs_entry, rhs_entry in itertools.zip_longest(lhs_items, rhs_items):
+        if lhs_entry and rhs_entry and lhs_entry[4] == rhs_entry[4]:
+            continue
+
+        # Report the first differing item in each file (or the end of a file, if it ran out of items first).
+        positions = []
+        for entry, mapped in ((lhs_entry, lhs), (rhs_entry, rhs)):
+            if entry is None:
+                positions += [_count_lines(mapped) + 1, 1, ""]
+            else:
+                line_number, column, text, text_column, _ = entry
+                positions += [line_number, column, _excerpt(text, text_column)]
+        return FileMismatch(*positions)
+
+    return None
+
+
+# Counts the lines in a mapped file (a final line without a newline counts).
+def _count_lines(mapped):
+    if not mapped:
+        return 0
+    count = 0
+    for start in range(0, len(mapped), COMPARE_BLOCK_SIZE):
+        count += mapped[start:start + COMPARE_BLOCK_SIZE].count(b"\n")
+    return count + (0 if mapped[-1:] == b"\n" else 1)
+
+
+# Compares two files and returns a FileMismatch describing the first difference, or None if they match. Modes:
+#   exact:       byte-for-byte
+#   whitespace:  line by line, ignoring the amount of whitespace between words (and at line ends) and blank lines
+#   tokens:      as the flattened parse_tokens output of each file (punctuation ignored, numbers normalized), which is
+#                how get_cmd_output results are usually compared; line breaks don't matter
+#   token_lines: line by line, as parse_tokens would tokenize them (blank lines ignored)
+def find_file_mismatch(lhs, rhs, mode="exact", is_case_sensitive=False, number_string_match=False):
+    if mode == "whitespace":
+        normalize, columns = _whitespace_items, _whitespace_columns
+    elif mode in ("tokens", "token_lines"):
+        normalize = lambda piece: list(itertools.chain(*iter_tokens(piece, is_case_sensitive, number_string_match)))
+        columns = lambda piece: _token_columns(piece, is_case_sensitive, number_string_match)
+    elif mode != "exact":
+        raise ValueError("Unknown file comparison mode '%s' (expected exact, whitespace, tokens, or token_lines)."
+                         % mode)
+
+    with _map_file(lhs) as lhs_mapped, _map_file(rhs) as rhs_mapped:
+        if mode == "exact":
+            return _find_exact_mismatch(lhs_mapped, rhs_mapped)
+        return _find_normalized_mismatch(lhs_mapped, rhs_mapped, normalize, columns, mode != "tokens")
+
+
+# Compares two files (see find_file_mismatch), returning 1 if they match and 0 otherwise; the mismatch is logged (debug).
+def compare_files(lhs, rhs, mode="exact", is_case_sensitive=False, number_string_match=False):
+    mismatch = find_file_mismatch(lhs, rhs, mode, is_case_sensitive, number_string_match)
+    if mismatch:
+        logging.debug("Files %s and %s differ at %s" % (lhs, rhs, mismatch))
+        return 0
+    return 1
+
 
+##### NUMERIC COMPARISON #####
+# Numeric output is split into tokens on whitespace and punctuation (except radix, signs, and exponent signs); tokens
+# that parse as floating point numbers (including inf / nan) are numbers, and the rest are words.
+_NUMERIC_PUNCTUATION = string.punctuation.translate(str.maketrans('', '', '.-+'))
+_NUMERIC_PUNC_TO_SPACE = str.maketrans(_NUMERIC_PUNCTUATION, " " * len(_NUMERIC_PUNCTUATION))
+_SIGN_BIT = numpy.uint64(1 << 63)
 
-# Changes dimensions, if necessary, to fit within the bounds of a screen.
-def __adjust_dimensions(text, x, y, width, height):
-    screen_height, screen_width = __get_screen_dimensions(text)
 
+class NumericTokens:
+    """Tokens of a text, split into a number mask, the numbers' values, and the remaining words"""
+    def __init__(self, text, is_case_sensitive=False):
+        tokens = (text if is_case_sensitive else text.lower()).translate(_NUMERIC_PUNC_TO_SPACE).split()
+        self.words = numpy.array(tokens, dtype=object)
+
+        # Usually (e.g., for a matrix) every token is a number and NumPy converts them all at once; otherwise, each
+        # token is converted on its own.
+        try:
+            self.values = numpy.array(tokens, dtype=numpy.float64)
+            self.is_number = numpy.ones(len(tokens), dtype=bool)
+        except ValueError:
+            self.values = numpy.zeros(len(tokens))
+            self.is_number = numpy.zeros(len(tokens), dtype=bool)
+            for index, token in enumerate(tokens):
+                value = _convert_type(float, token)
+                if value is not None:
+                    self.values[index] = value
+                    self.is_number[index] = True
+
+
+    def __len__(self):
+        return len(self.is_number)
+
+
+# Maps doubles to unsigned integers in the same order, so that the difference of two is their distance in ULPs.
+def _ordered_bits(values):
+    bits = values.view(numpy.uint64)
+    return numpy.where(bits & _SIGN_BIT, ~bits, bits | _SIGN_BIT)
+
+
+# Returns which pairs of values are equal within the tolerances: |a - b| <= max(abs_tol, rel_tol * max(|a|, |b|)), or
+# at most "ulps" representable doubles apart. Equal infinities match; NaNs match each other only if nan_equal is set.
+def numbers_close(lhs, rhs, abs_tol=1e-9, rel_tol=1e-6, ulps=None, nan_equal=False):
+    lhs, rhs = numpy.asarray(lhs, dtype=numpy.float64), numpy.asarray(rhs, dtype=numpy.float64)
+    with numpy.errstate(invalid="ignore", over="ignore"):
+        close = (lhs == rhs) | (numpy.abs(lhs - rhs) <= numpy.maximum(abs_tol, rel_tol * numpy.maximum(numpy.abs(lhs),
+                                                                                                        numpy.abs(rhs))))
+        if ulps is not None:
+            lhs_bits, rhs_bits = _ordered_bits(lhs), _ordered_bits(rhs)
+            distance = numpy.where(lhs_bits > rhs_bits, lhs_bits - rhs_bits, rhs_bits - lhs_bits)
+            close |= (distance <= ulps) & ~numpy.isnan(lhs) & ~numpy.isnan(rhs)
+    if nan_equal:
+        close |= numpy.isnan(lhs) & numpy.isnan(rhs)
+    return close
+
+
+# Compares numeric output (text, or token lists such as those from parse_tokens) token by token: numbers within the
+# tolerances (see numbers_close) and identical words match. Returns the fraction of tokens matched, for partial credit
+# (1 for a full match).
+def compare_numeric(lhs, rhs, abs_tol=1e-9, rel_tol=1e-6, ulps=None, nan_equal=False, is_case_sensitive=False):
+    lhs, rhs = [NumericTokens(_numeric_text(side), is_case_sensitive) for side in (lhs, rhs)]
+    total = max(len(lhs), len(rhs))
+    if total == 0:
+        return 1
+
+    # Tokens are compared position by position (up to the shorter length); extra tokens count as mismatches.
+    length = min(len(lhs), len(rhs))
+    numbers = lhs.is_number[:length] & rhs.is_number[:length]
+    words = ~lhs.is_number[:length] & ~rhs.is_number[:length]
+    matched = numbers & numbers_close(lhs.values[:length], rhs.values[:length], abs_tol, rel_tol, ulps, nan_equal)
+    matched |= words & (lhs.words[:length] == rhs.words[:length])
+    return int(numpy.count_nonzero(matched)) / total
+
+
+def _numeric_text(tokens):
+    if isinstance(tokens, str):
+        return tokens
+    return " ".join(_numeric_text(token) if not isinstance(token, str) else token for token in tokens)
+
+
+##### SCREEN COMPARISON #####
+_CELL_TYPE = numpy.dtype('<u4')
+_SPACE = ord(" ")
+
+
+# Clamps a region (x, y, width, height) so that it fits within the bounds of a screen.
+def _clamp_region(screen_height, screen_width, x, y, width, height):
     # Make sure the x/y positions are within the range of the screen
     if x < 0:
         width += x
@@ -825,96 +2620,160 @@ def __adjust_dimensions(text, x, y, width, height):
     return x, y, width, height
 
 
-# Get a subscreen of a larger screen
-def get_subscreen(text, x, y, width, height):
-    # Get the screen in row, col format if it isn't already.
-    if isinstance(text, str) or not hasattr(text, '__iter__'):
-        text = str(text).splitlines()
-    for index in range(len(text)):
-        text[index] = str(text[index])
+class Screen:
+    """Grid of character cells (rows x columns of code points) supporting fast slicing and comparison of screens"""
+    def __init__(self, text):
+        if isinstance(text, Screen):
+            self._grid = text._grid
+            return
+
+        # Get the screen in row, col format if it isn't already. The first row determines the width (as a terminal's).
+        if isinstance(text, str) or not hasattr(text, '__iter__'):
+            text = str(text).splitlines()
+        rows = [str(row) for row in text]
+        width = len(rows[0]) if rows else 0
 
-    # Fix the dimensions if any of them are out of bounds.
-    x, y, width, height = __adjust_dimensions(text, x, y, width, height)
+        data = "".join(row[:width].ljust(width) for row in rows).encode('utf-32-le', 'surrogatepass')
+        if data:
+            self._grid = numpy.frombuffer(data, dtype=_CELL_TYPE).reshape(len(rows), width)
+        else:
+            self._grid = numpy.zeros((len(rows), width), dtype=_CELL_TYPE)
 
-    # Grab the subscreen and return it.
-    text = [''.join([text[y_pos][x_pos] for x_pos in range(x, x + width)]) for y_pos in range(y, y + height)]
-    return text
 
+    @classmethod
+    def _from_grid(cls, grid):
+        screen = cls.__new__(cls)
+        screen._grid = grid
+        return screen
 
-# Get a subscreen of a larger screen with an area cut out (filled with spaces)
-def get_cutout(text, x, y, width, height, hollow_x, hollow_y, hollow_width, hollow_height):
-    # Adjust the hollow coordinates to be based on the subscreen, which we will grab presently.
-    if x >= 0:
-        hollow_x -= x
-    if y >= 0:
-        hollow_y -= y
-
-    # If the hollow coordinates are negative, zero them and reduce the hollow size accordingly.
-    if hollow_x < 0:
-        hollow_width += hollow_x
-        hollow_x = 0
-
-    if hollow_y < 0:
-        hollow_height += hollow_y
-        hollow_y = 0
-
-    # Get the subscreen
-    text = get_subscreen(text, x, y, width, height)
-    height, width = __get_screen_dimensions(text)
-
-    # If the hollow starts outside of the subscreen, just return the subscreen.
-    if hollow_x >= width or hollow_y >= height:
-        return text
 
-    # Adjust the hollow dimensions to fit within the subscreen.
-    hollow_x, hollow_y, hollow_width, hollow_height = __adjust_dimensions(text, hollow_x, hollow_y, hollow_width, hollow_height)
+    @property
+    def height(self):
+        return self._grid.shape[0]
+
+
+    @property
+    def width(self):
+        return self._grid.shape[1]
+
+
+    @property
+    def lines(self):
+        return [row.tobytes().decode('utf-32-le', 'surrogatepass') for row in self._grid]
+
+
+    def __str__(self):
+        return "\n".join(self.lines)
+
+
+    # Returns a view (no copy) of a region of this screen, clamped to the screen bounds.
+    def subscreen(self, x, y, width, height):
+        x, y, width, height = _clamp_region(self.height, self.width, x, y, width, height)
+        return Screen._from_grid(self._grid[y:y + height, x:x + (width if height else 0)])
+
 
-    # With the subscreen grabbed and the hollow within the subscreen, it's time to get the values.
-    cutout_screen = [[" " for _ in range(width)] for _ in range(height)]
-    for y in range(height):
-        for x in range(width):
-            if not __pos_in_range(x, y, hollow_x, hollow_y, hollow_width, hollow_height):
-                cutout_screen[y][x] = text[y][x]
+    # Returns a region of the screen with an area (hollow) cut out and filled with spaces.
+    def cutout(self, x, y, width, height, hollow_x, hollow_y, hollow_width, hollow_height):
+        # Adjust the hollow coordinates to be based on the subscreen, which we will grab presently.
+        if x >= 0:
+            hollow_x -= x
+        if y >= 0:
+            hollow_y -= y
 
-    return ["".join(row) for row in cutout_screen]
+        # If the hollow coordinates are negative, zero them and reduce the hollow size accordingly.
+        if hollow_x < 0:
+            hollow_width += hollow_x
+            hollow_x = 0
+
+        if hollow_y < 0:
+            hollow_height += hollow_y
+            hollow_y = 0
+
+        # Get the subscreen. If the hollow starts outside of it, just return the subscreen.
+        screen = self.subscreen(x, y, width, height)
+        if hollow_x >= screen.width or hollow_y >= screen.height:
+            return screen
+
+        # Adjust the hollow dimensions to fit within the subscreen, then blank out the hollow in a copy.
+        hollow_x, hollow_y, hollow_width, hollow_height = _clamp_region(screen.height, screen.width, hollow_x,
+                                                                        hollow_y, hollow_width, hollow_height)
+        grid = screen._grid.copy()
+        grid[hollow_y:hollow_y + hollow_height, hollow_x:hollow_x + hollow_width] = _SPACE
+        return Screen._from_grid(grid)
+
+
+    # Returns a copy of this screen with all characters converted to lower case.
+    def casefold(self):
+        grid = self._grid
+        folded = numpy.where((grid >= ord("A")) & (grid <= ord("Z")), grid + (ord("a") - ord("A")), grid)
+
+        # Non-ASCII characters are rare on screens, so fold each distinct one individually.
+        for code in numpy.unique(grid[grid > 0x7F]):
+            lower = chr(code).lower()
+            if len(lower) == 1:
+                folded[grid == code] = ord(lower)
+
+        return Screen._from_grid(folded.astype(_CELL_TYPE, copy=False))
+
+
+    # Returns a boolean grid of cells that match in this and another screen of the same size (None if sizes differ).
+    def _matching_cells(self, other, case_sensitive):
+        other = Screen(other)
+        if (self.height, self.width) != (other.height, other.width):
+            return None
+
+        lhs, rhs = (self, other) if case_sensitive else (self.casefold(), other.casefold())
+        return lhs._grid == rhs._grid
+
+
+    # Returns true if both screens are the same size and every cell matches.
+    def equals(self, other, case_sensitive=False):
+        matches = self._matching_cells(other, case_sensitive)
+        return matches is not None and bool(matches.all())
+
+
+    # Returns the fraction of cells that match (for partial credit); screens of different sizes are compared over
+    # their overlap, with the cells outside of the overlap counting as mismatches.
+    def similarity(self, other, case_sensitive=False):
+        other = Screen(other)
+        height, width = min(self.height, other.height), min(self.width, other.width)
+        total = max(self.height, other.height) * max(self.width, other.width)
+        if total == 0:
+            return 1.0
+
+        matches = self.subscreen(0, 0, width, height)._matching_cells(other.subscreen(0, 0, width, height), case_sensitive)
+        return int(matches.sum()) / total
+
+
+# Get a subscreen of a larger screen
+def get_subscreen(text, x, y, width, height):
+    return Screen(text).subscreen(x, y, width, height).lines
+
+
+# Get a subscreen of a larger screen with an area cut out (filled with spaces)
+def get_cutout(text, x, y, width, height, hollow_x, hollow_y, hollow_width, hollow_height):
+    return Screen(text).cutout(x, y, width, height, hollow_x, hollow_y, hollow_width, hollow_height).lines
 
 
 # Compare two screens to see if they are identical.
 def compare_screen(lhs, rhs, case_sensitive=False):
-    # Get the screens in row, col format if they aren't already.
-    if isinstance(lhs, str) or not hasattr(lhs, '__iter__'):
-        lhs = str(lhs).splitlines()
-    if isinstance(rhs, str) or not hasattr(rhs, '__iter__'):
-        rhs = str(rhs).splitlines()
-    for index in range(len(lhs)):
-        lhs[index] = str(lhs[index])
-    for index in range(len(rhs)):
-        rhs[index] = str(rhs[index])
-
-    # If the screens are not the same size, this comparison automatically fails. (Error here?)
-    height, width = __get_screen_dimensions(lhs)
-    if __get_screen_dimensions(rhs) != (height, width):
-        return 0
+    return 1 if Screen(lhs).equals(rhs, case_sensitive) else 0
 
-    # Check every cell; if any do not match, the comparison fails.
-    for y in range(height):
-        lhs[y] = lhs[y] if case_sensitive else lhs[y].lower()
-        rhs[y] = rhs[y] if case_sensitive else rhs[y].lower()
-        for x in range(width):
-            if lhs[y][x] != rhs[y][x]:
-                return 0
-    return 1
+
+# Compare two screens and return the fraction of matching cells (for partial credit).
+def compare_screen_partial(lhs, rhs, case_sensitive=False):
+    return Screen(lhs).similarity(rhs, case_sensitive)
 
 
 # Compare subscreens of two screens to see if they are identical.
 def compare_subscreen(lhs, rhs, x, y, width, height, case_sensitive=False):
-    lhs = get_subscreen(lhs, x, y, width, height)
-    rhs = get_subscreen(rhs, x, y, width, height)
-    return compare_screen(lhs, rhs, case_sensitive)
+    lhs = Screen(lhs).subscreen(x, y, width, height)
+    rhs = Screen(rhs).subscreen(x, y, width, height)
+    return 1 if lhs.equals(rhs, case_sensitive) else 0
 
 
 # Compare cutout subscreens of two screens to see if they are equal.
 def compare_cutout(lhs, rhs, x, y, width, height, hollow_x, hollow_y, hollow_width, hollow_height, case_sensitive=False):
-    lhs = get_cutout(lhs, x, y, width, height, hollow_x, hollow_y, hollow_width, hollow_height)
-    rhs = get_cutout(rhs, x, y, width, height, hollow_x, hollow_y, hollow_width, hollow_height)
-    return compare_screen(lhs, rhs, case_sensitive)
+    lhs = Screen(lhs).cutout(x, y, width, height, hollow_x, hollow_y, hollow_width, hollow_height)
+    rhs = Screen(rhs).cutout(x, y, width, height, hollow_x, hollow_y, hollow_width, hollow_height)
+    return 1 if lhs.equals(rhs, case_sensitive) else 0
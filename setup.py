@@ -9,13 +9,14 @@ setup(
     author='Jeremiah Blanchard',
     author_email='jjb@eng.ufl.edu',
     description='Test suite tools for instructors',
-    install_requires=['pexpect>=4.8.0', 'pyte>=0.8.0', 'pathos>=0.2.7', 'monkeydict>=1.0'],
+    install_requires=['pexpect>=4.8.0', 'pyte>=0.8.0', 'pathos>=0.2.7', 'monkeydict>=1.0', 'numpy>=1.17'],
 
     entry_points =
     { 'console_scripts':
         [
             'elma = herptest.extract_lms_archive:main',
-            'herp = herptest.run_test_suite:main'
+            'herp = herptest.run_test_suite:main',
+            'herp-similar = herptest.find_similar:main'
         ]
     }
 )